@@ -2,23 +2,140 @@
 Módulo de análise para Crimes Violentos contra o Patrimônio (CVP)
 """
 import streamlit as st
+import streamlit.components.v1 as components
 import pandas as pd
+import polars as pl
 import plotly.express as px
-import calendar
+import plotly.graph_objects as go
 from datetime import datetime
-from .utils import criar_mapa_calor, exibir_metricas_principais
+from .utils import (
+    agregar_mapa_calor, html_mapa_calor, exibir_metricas_principais, ler_excel_com_cache, mascara_valores, otimizar_tipos,
+    reamostrar_figura, listar_opcoes, contar_distintos, nomear_meses, exportar_csv, exportar_parquet, MES_ABBR
+)
 
 
-@st.cache_data
-def carregar_dados_cvp(arquivo, sheet):
-    df = pd.read_excel(arquivo, sheet_name=sheet)
-    df = df.rename(columns={
-        'MUNICÍPIO': 'MUNICIPIO',
-        'REGIÃO GEOGRÁFICA': 'REGIAO_GEOGRAFICA'
-    })
+# Colunas lidas da planilha e seus nomes padronizados
+COLUNAS_PLANILHA = {
+    'DATA': 'DATA',
+    'ANO': 'ANO',
+    'MUNICÍPIO': 'MUNICIPIO',
+    'REGIÃO GEOGRÁFICA': 'REGIAO_GEOGRAFICA',
+    'TOTAL': 'TOTAL'
+}
+
+
+def _preparar_cvp(df):
+    df = df.rename(columns=COLUNAS_PLANILHA)
     df['DATA'] = pd.to_datetime(df['DATA'])
     df['MES'] = df['DATA'].dt.month
-    return df
+    return otimizar_tipos(df)
+
+
+@st.cache_resource(show_spinner=False)
+def carregar_dados_cvp(arquivo, sheet):
+    """
+    Carrega os dados de CVP. O DataFrame é compartilhado entre as sessões
+    sem cópia, então deve ser tratado como somente leitura; após reiniciar
+    o servidor ele é recriado a partir do cache Parquet.
+    """
+    return ler_excel_com_cache(arquivo, sheet, _preparar_cvp, list(COLUNAS_PLANILHA))
+
+
+@st.cache_data(show_spinner=False)
+def obter_opcoes_cvp(arquivo, sheet):
+    """Valores disponíveis nos filtros, calculados uma única vez por base"""
+    df = carregar_dados_cvp(arquivo, sheet)
+    return listar_opcoes(df, ['ANO', 'REGIAO_GEOGRAFICA', 'MUNICIPIO'])
+
+
+def _filtrar_cvp(df, ano_inicio, ano_fim, regioes, municipios):
+    anos = df['ANO'].to_numpy()
+    mascara = (anos >= ano_inicio) & (anos <= ano_fim)
+    if 'Todas' not in regioes:
+        mascara &= mascara_valores(df['REGIAO_GEOGRAFICA'], regioes)
+    if 'Todos' not in municipios:
+        mascara &= mascara_valores(df['MUNICIPIO'], municipios)
+    return df[mascara]
+
+
+@st.cache_data(show_spinner=False)
+def calcular_agregados_cvp(arquivo, sheet, ano_inicio, ano_fim, regioes, municipios):
+    """Agrega os dados filtrados uma única vez por combinação de filtros"""
+    df = carregar_dados_cvp(arquivo, sheet)
+    df_filt = _filtrar_cvp(df, ano_inicio, ano_fim, regioes, municipios)
+    
+    df_regiao = (
+        pl.from_pandas(df_filt[['REGIAO_GEOGRAFICA', 'MUNICIPIO', 'TOTAL']])
+        .drop_nulls('REGIAO_GEOGRAFICA')
+        .group_by('REGIAO_GEOGRAFICA')
+        .agg([pl.col('TOTAL').sum(), pl.col('MUNICIPIO').drop_nulls().n_unique()])
+        .sort('REGIAO_GEOGRAFICA')
+        .to_pandas()
+    )
+    
+    return {
+        'total': df_filt['TOTAL'].to_numpy().sum(),
+        'municipios': contar_distintos(df_filt['MUNICIPIO']),
+        'por_ano': df_filt.groupby('ANO', observed=True, sort=False)['TOTAL'].sum().sort_index().reset_index(),
+        'por_mes': df_filt.groupby('MES', observed=True, sort=False)['TOTAL'].sum().sort_index().reset_index()
+                          .assign(MES_NOME=lambda d: nomear_meses(d['MES'])),
+        # Top 20 para o ranking; o gráfico usa os 15 primeiros
+        'top_municipios': df_filt.groupby('MUNICIPIO', observed=True, sort=False)['TOTAL'].sum().nlargest(20).reset_index(),
+        'por_regiao': df_regiao
+    }
+
+
+@st.cache_data(show_spinner=False)
+def montar_figuras_cvp(arquivo, sheet, ano_inicio, ano_fim, regioes, municipios):
+    """
+    Monta os gráficos uma única vez por combinação de filtros, já serializados.
+    Na exibição cada um volta a ser um go.Figure, que aceita gráficos sem séries
+    quando o filtro não retorna registros.
+    """
+    agregados = calcular_agregados_cvp(arquivo, sheet, ano_inicio, ano_fim, regioes, municipios)
+    
+    fig_ano = px.line(agregados['por_ano'], x='ANO', y='TOTAL', markers=True, title='Evolução Anual')
+    fig_ano.update_traces(line_color='#2ca02c', line_width=3)
+    
+    fig_mes = px.bar(agregados['por_mes'], x='MES_NOME', y='TOTAL', title='Distribuição Mensal',
+                     category_orders={'MES_NOME': MES_ABBR[1:].tolist()})
+    
+    df_mun = agregados['top_municipios'].head(15)
+    fig_mun = px.bar(df_mun, x='TOTAL', y='MUNICIPIO', orientation='h', title='Top 15 Municípios')
+    fig_mun.update_layout(yaxis={'categoryorder':'total ascending'})
+    
+    fig_reg = px.pie(agregados['por_regiao'], values='TOTAL', names='REGIAO_GEOGRAFICA', hole=0.4, title='Por Região')
+    
+    return {
+        'por_ano': reamostrar_figura(fig_ano).to_plotly_json(),
+        'por_mes': fig_mes.to_plotly_json(),
+        'por_municipio': fig_mun.to_plotly_json(),
+        'por_regiao': fig_reg.to_plotly_json()
+    }
+
+
+@st.cache_data(show_spinner=False)
+def calcular_mapa_cvp(arquivo, sheet, ano_inicio, ano_fim, regioes, municipios, ano_mapa, top_n):
+    """Top N de municípios do mapa, calculado uma única vez por combinação de filtros"""
+    df = carregar_dados_cvp(arquivo, sheet)
+    df_filt = _filtrar_cvp(df, ano_inicio, ano_fim, regioes, municipios)
+    return agregar_mapa_calor(df_filt, 'MUNICIPIO', 'TOTAL', ano_mapa, None, top_n)
+
+
+@st.cache_data(show_spinner=False)
+def gerar_csv_cvp(arquivo, sheet, ano_inicio, ano_fim, regioes, municipios):
+    """Serializa os dados filtrados em CSV uma única vez por combinação de filtros"""
+    df = carregar_dados_cvp(arquivo, sheet)
+    df_filt = _filtrar_cvp(df, ano_inicio, ano_fim, regioes, municipios)
+    return exportar_csv(df_filt)
+
+
+@st.cache_data(show_spinner=False)
+def gerar_parquet_cvp(arquivo, sheet, ano_inicio, ano_fim, regioes, municipios):
+    """Serializa os dados filtrados em Parquet uma única vez por combinação de filtros"""
+    df = carregar_dados_cvp(arquivo, sheet)
+    df_filt = _filtrar_cvp(df, ano_inicio, ano_fim, regioes, municipios)
+    return exportar_parquet(df_filt)
 
 
 def render(base_info):
@@ -29,36 +146,36 @@ def render(base_info):
     st.markdown(f"**Período:** {base_info['periodo']} | **Total de registros:** {len(df):,}")
     
     # Filtros
+    opcoes = obter_opcoes_cvp(base_info['arquivo'], base_info['sheet'])
     st.sidebar.header("🔍 Filtros")
-    anos = sorted(df['ANO'].unique())
+    anos = opcoes['ANO']
     col1, col2 = st.sidebar.columns(2)
     ano_inicio = col1.selectbox("Ano inicial", anos, index=0)
     ano_fim = col2.selectbox("Ano final", anos, index=len(anos)-1)
     
-    regioes = ['Todas'] + sorted(df['REGIAO_GEOGRAFICA'].unique().tolist())
+    regioes = ['Todas'] + opcoes['REGIAO_GEOGRAFICA']
     regiao = st.sidebar.multiselect("Região", regioes, default=['Todas'])
     
-    municipios = ['Todos'] + sorted(df['MUNICIPIO'].unique().tolist())
+    municipios = ['Todos'] + opcoes['MUNICIPIO']
     municipio = st.sidebar.multiselect("Município", municipios, default=['Todos'])
     
     # Aplicar filtros
-    df_filt = df[(df['ANO'] >= ano_inicio) & (df['ANO'] <= ano_fim)]
-    if 'Todas' not in regiao:
-        df_filt = df_filt[df_filt['REGIAO_GEOGRAFICA'].isin(regiao)]
-    if 'Todos' not in municipio:
-        df_filt = df_filt[df_filt['MUNICIPIO'].isin(municipio)]
+    filtros = (ano_inicio, ano_fim, tuple(regiao), tuple(municipio))
+    agregados = calcular_agregados_cvp(base_info['arquivo'], base_info['sheet'], *filtros)
+    figuras = montar_figuras_cvp(base_info['arquivo'], base_info['sheet'], *filtros)
+    df_ano = agregados['por_ano']
     
     # Métricas
     st.header("📊 Indicadores")
     col1, col2, col3, col4 = st.columns(4)
     with col1:
-        st.metric("Total de Casos", f"{df_filt['TOTAL'].sum():,}")
+        st.metric("Total de Casos", f"{agregados['total']:,}")
     with col2:
-        st.metric("Média Anual", f"{df_filt.groupby('ANO')['TOTAL'].sum().mean():.0f}")
+        st.metric("Média Anual", f"{df_ano['TOTAL'].mean():.0f}")
     with col3:
-        st.metric("Municípios", f"{df_filt['MUNICIPIO'].nunique()}")
+        st.metric("Municípios", f"{agregados['municipios']}")
     with col4:
-        st.metric("Média Diária", f"{df_filt['TOTAL'].sum() / len(df_filt['ANO'].unique()) / 365:.1f}")
+        st.metric("Média Diária", f"{agregados['total'] / len(df_ano) / 365:.1f}")
     
     st.markdown("---")
     
@@ -66,60 +183,76 @@ def render(base_info):
     tab1, tab2, tab3 = st.tabs(["📈 Evolução", "🗺️ Geografia", "📊 Detalhes"])
     
     with tab1:
-        col1, col2 = st.columns(2)
-        with col1:
-            df_ano = df_filt.groupby('ANO')['TOTAL'].sum().reset_index()
-            fig = px.line(df_ano, x='ANO', y='TOTAL', markers=True, title='Evolução Anual')
-            fig.update_traces(line_color='#2ca02c', line_width=3)
-            st.plotly_chart(fig, use_container_width=True)
-        
-        with col2:
-            df_mes = df_filt.groupby('MES')['TOTAL'].sum().reset_index()
-            df_mes['MES_NOME'] = df_mes['MES'].apply(lambda x: calendar.month_abbr[x])
-            fig = px.bar(df_mes, x='MES_NOME', y='TOTAL', title='Distribuição Mensal')
-            st.plotly_chart(fig, use_container_width=True)
+        render_evolucao(figuras)
     
     with tab2:
-        st.subheader("🗺️ Mapa")
-        col1, col2 = st.columns([3, 1])
-        with col2:
-            ano_map = st.selectbox("Ano", ['Todos'] + anos)
-            top_n = st.slider("Top N", 5, 30, 15)
-        with col1:
-            ano_f = None if ano_map == 'Todos' else ano_map
-            mapa = criar_mapa_calor(df_filt, 'MUNICIPIO', 'TOTAL', ano_f, None, top_n)
-            from streamlit_folium import st_folium
-            st_folium(mapa, width=700, height=500)
-        
-        col1, col2 = st.columns(2)
-        with col1:
-            df_mun = df_filt.groupby('MUNICIPIO')['TOTAL'].sum().sort_values(ascending=False).head(15).reset_index()
-            fig = px.bar(df_mun, x='TOTAL', y='MUNICIPIO', orientation='h', title='Top 15 Municípios')
-            fig.update_layout(yaxis={'categoryorder':'total ascending'})
-            st.plotly_chart(fig, use_container_width=True)
-        
-        with col2:
-            df_reg = df_filt.groupby('REGIAO_GEOGRAFICA')['TOTAL'].sum().reset_index()
-            fig = px.pie(df_reg, values='TOTAL', names='REGIAO_GEOGRAFICA', hole=0.4, title='Por Região')
-            st.plotly_chart(fig, use_container_width=True)
+        render_geografia(base_info, filtros, anos, figuras)
     
     with tab3:
-        col1, col2 = st.columns(2)
-        with col1:
-            st.subheader("Ranking Municípios")
-            df_rank = df_filt.groupby('MUNICIPIO')['TOTAL'].sum().sort_values(ascending=False).head(20).reset_index()
-            st.dataframe(df_rank, use_container_width=True)
-        
-        with col2:
-            st.subheader("Por Região")
-            df_stats = df_filt.groupby('REGIAO_GEOGRAFICA').agg({
-                'TOTAL': 'sum',
-                'MUNICIPIO': 'nunique'
-            }).reset_index()
-            df_stats.columns = ['Região', 'Total', 'Municípios']
-            st.dataframe(df_stats, use_container_width=True)
-        
-        csv = df_filt.to_csv(index=False).encode('utf-8')
+        render_detalhes(base_info, filtros, agregados)
+
+
+@st.fragment
+def render_evolucao(figuras):
+    """Renderiza a aba de evolução"""
+    col1, col2 = st.columns(2)
+    with col1:
+        st.plotly_chart(go.Figure(figuras['por_ano']), use_container_width=True)
+    
+    with col2:
+        st.plotly_chart(go.Figure(figuras['por_mes']), use_container_width=True)
+
+
+@st.fragment
+def render_geografia(base_info, filtros, anos, figuras):
+    """Renderiza a aba de geografia"""
+    render_mapa(base_info, filtros, anos)
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        st.plotly_chart(go.Figure(figuras['por_municipio']), use_container_width=True)
+    
+    with col2:
+        st.plotly_chart(go.Figure(figuras['por_regiao']), use_container_width=True)
+
+
+@st.fragment
+def render_mapa(base_info, filtros, anos):
+    """Renderiza o mapa; mudar o ano ou o Top N só reexecuta este bloco"""
+    st.subheader("🗺️ Mapa")
+    col1, col2 = st.columns([3, 1])
+    with col2:
+        ano_map = st.selectbox("Ano", ['Todos'] + anos)
+        top_n = st.slider("Top N", 5, 30, 15)
+    with col1:
+        ano_f = None if ano_map == 'Todos' else ano_map
+        df_top = calcular_mapa_cvp(base_info['arquivo'], base_info['sheet'], *filtros, ano_f, top_n)
+        components.html(html_mapa_calor(df_top, 'MUNICIPIO', 'TOTAL'), width=700, height=500)
+
+
+@st.fragment
+def render_detalhes(base_info, filtros, agregados):
+    """Renderiza a aba de detalhes"""
+    col1, col2 = st.columns(2)
+    with col1:
+        st.subheader("Ranking Municípios")
+        df_rank = agregados['top_municipios']
+        st.dataframe(df_rank, use_container_width=True)
+    
+    with col2:
+        st.subheader("Por Região")
+        df_stats = agregados['por_regiao'].copy()
+        df_stats.columns = ['Região', 'Total', 'Municípios']
+        st.dataframe(df_stats, use_container_width=True)
+    
+    parquet = gerar_parquet_cvp(base_info['arquivo'], base_info['sheet'], *filtros)
+    st.download_button("📥 Download Parquet", data=parquet,
+                      file_name=f'cvp_pe_{datetime.now().strftime("%Y%m%d")}.parquet',
+                      mime='application/octet-stream')
+    
+    # CSV só é gerado quando pedido
+    if st.checkbox("Exportar também em CSV"):
+        csv = gerar_csv_cvp(base_info['arquivo'], base_info['sheet'], *filtros)
         st.download_button("📥 Download CSV", data=csv,
                           file_name=f'cvp_pe_{datetime.now().strftime("%Y%m%d")}.csv',
                           mime='text/csv')
@@ -2,34 +2,177 @@
 MÃ³dulo de anÃ¡lise para Estupro e Crimes Sexuais
 """
 import streamlit as st
+import streamlit.components.v1 as components
 import pandas as pd
 import plotly.express as px
-import calendar
+import plotly.graph_objects as go
 from datetime import datetime
-from streamlit_folium import st_folium
-from .utils import criar_mapa_calor, criar_filtros_padrao, aplicar_filtros, exibir_metricas_principais
+from .utils import (
+    agregar_mapa_calor, html_mapa_calor, criar_filtros_padrao, mascara_filtros, mascara_valores, exibir_metricas_principais,
+    ler_excel_com_cache, otimizar_tipos, reamostrar_figura, escolher_modo_renderizacao, listar_opcoes,
+    somar_por_grupos, contar_distintos, nomear_meses, exportar_csv, exportar_parquet, MES_ABBR
+)
 
 
-@st.cache_data
-def carregar_dados_estupro(arquivo, sheet):
-    """Carrega e prepara os dados de Estupro"""
-    df = pd.read_excel(arquivo, sheet_name=sheet)
-    
+# Colunas lidas da planilha e seus nomes padronizados
+COLUNAS_PLANILHA = {
+    'MUNICÍPIO DO FATO': 'MUNICIPIO',
+    'REGIAO GEOGRÁFICA': 'REGIAO_GEOGRAFICA',
+    'NATUREZA': 'NATUREZA',
+    'DATA DO FATO': 'DATA',
+    'ANO': 'ANO',
+    'SEXO': 'SEXO',
+    'IDADE SENASP': 'FAIXA_IDADE',
+    'TOTAL DE VÍTIMAS': 'TOTAL'
+}
+
+# Colunas auxiliares criadas no carregamento, fora da exportação
+COLUNAS_INTERNAS_ESTUPRO = ['_IS_FEM', '_IS_MENOR']
+
+
+def _preparar_estupro(df):
+    """Padroniza colunas e tipos da planilha de Estupro"""
     # Renomear colunas para padrão
-    df = df.rename(columns={
-        'MUNICÍPIO DO FATO': 'MUNICIPIO',
-        'REGIAO GEOGRÁFICA': 'REGIAO_GEOGRAFICA',
-        'DATA DO FATO': 'DATA',
-        'IDADE SENASP': 'FAIXA_IDADE',
-        'TOTAL DE VÍTIMAS': 'TOTAL'
-    })
+    df = df.rename(columns=COLUNAS_PLANILHA)
     
     # Preparar dados
     df['DATA'] = pd.to_datetime(df['DATA'])
     df['MES'] = df['DATA'].dt.month
-    df['MES_NOME'] = df['DATA'].dt.month_name()
     
-    return df
+    # Indicadores 0/1 usados nas métricas de % Feminino e % Menores
+    df['_IS_FEM'] = df['SEXO'].astype(str).str.contains('FEM', case=False).astype('uint8')
+    df['_IS_MENOR'] = df['FAIXA_IDADE'].astype(str).str.contains('00-11|12-17', case=False).astype('uint8')
+
+    return otimizar_tipos(df)
+
+
+@st.cache_resource(show_spinner=False)
+def carregar_dados_estupro(arquivo, sheet):
+    """
+    Carrega e prepara os dados de Estupro. O DataFrame é compartilhado entre
+    as sessões sem cópia, então deve ser tratado como somente leitura; após
+    reiniciar o servidor ele é recriado a partir do cache Parquet.
+    """
+    return ler_excel_com_cache(arquivo, sheet, _preparar_estupro, list(COLUNAS_PLANILHA))
+
+
+@st.cache_data(show_spinner=False)
+def obter_opcoes_estupro(arquivo, sheet):
+    """Valores disponíveis nos filtros, calculados uma única vez por base"""
+    df = carregar_dados_estupro(arquivo, sheet)
+    return listar_opcoes(df, ['ANO', 'REGIAO_GEOGRAFICA', 'MUNICIPIO', 'SEXO', 'NATUREZA', 'FAIXA_IDADE'])
+
+
+def _filtrar_estupro(df, filtros):
+    """Aplica os filtros padrão e os específicos de Estupro"""
+    mascara = mascara_filtros(df, filtros)
+    
+    if 'Todas' not in filtros['naturezas'] and len(filtros['naturezas']) > 0:
+        mascara &= mascara_valores(df['NATUREZA'], filtros['naturezas'])
+    
+    if 'Todas' not in filtros['faixas_idade'] and len(filtros['faixas_idade']) > 0:
+        mascara &= mascara_valores(df['FAIXA_IDADE'], filtros['faixas_idade'])
+    
+    return df[mascara]
+
+
+@st.cache_data(show_spinner=False)
+def calcular_agregados_estupro(arquivo, sheet, filtros):
+    """Agrega os dados filtrados uma única vez por combinação de filtros"""
+    df = carregar_dados_estupro(arquivo, sheet)
+    df_filtrado = _filtrar_estupro(df, filtros)
+    
+    agregados = somar_por_grupos(df_filtrado, 'TOTAL', {
+        'por_ano': ('ANO', False),
+        'por_mes': ('MES', False),
+        'por_ano_natureza': (['ANO', 'NATUREZA'], False),
+        'por_municipio': ('MUNICIPIO', True),
+        'por_regiao': ('REGIAO_GEOGRAFICA', False),
+        'por_sexo': ('SEXO', False),
+        'por_faixa_idade': ('FAIXA_IDADE', True),
+        'por_faixa_natureza': (['FAIXA_IDADE', 'NATUREZA'], False),
+        'por_natureza': ('NATUREZA', True)
+    })
+    
+    agregados['por_mes'] = agregados['por_mes'].assign(MES_NOME=lambda d: nomear_meses(d['MES']))
+    
+    totais = df_filtrado['TOTAL'].to_numpy()
+    agregados.update({
+        'total': totais.sum(),
+        'total_feminino': (totais * df_filtrado['_IS_FEM'].to_numpy()).sum(),
+        'total_menores': (totais * df_filtrado['_IS_MENOR'].to_numpy()).sum(),
+        'registros': len(df_filtrado),
+        'municipios': contar_distintos(df_filtrado['MUNICIPIO'])
+    })
+    return agregados
+
+
+@st.cache_data(show_spinner=False)
+def montar_figuras_estupro(arquivo, sheet, filtros, render_mode):
+    """
+    Monta os gráficos uma única vez por combinação de filtros, já serializados.
+    Na exibição cada um volta a ser um go.Figure, que aceita gráficos sem séries
+    quando o filtro não retorna registros.
+    """
+    agregados = calcular_agregados_estupro(arquivo, sheet, filtros)
+    
+    fig_ano = px.line(agregados['por_ano'], x='ANO', y='TOTAL', markers=True,
+                      title='Evolução Anual de Casos', render_mode=render_mode)
+    fig_ano.update_traces(line_color='#ff7f0e', line_width=3)
+    
+    fig_mes = px.bar(agregados['por_mes'], x='MES_NOME', y='TOTAL', title='Distribuição Mensal',
+                     category_orders={'MES_NOME': MES_ABBR[1:].tolist()})
+    
+    fig_nat = px.line(agregados['por_ano_natureza'], x='ANO', y='TOTAL', color='NATUREZA', markers=True,
+                      render_mode=render_mode)
+    fig_nat.update_layout(height=500)
+    
+    fig_mun = px.bar(agregados['por_municipio'].head(15), x='TOTAL', y='MUNICIPIO', orientation='h')
+    fig_mun.update_layout(yaxis={'categoryorder':'total ascending'})
+    
+    fig_reg = px.pie(agregados['por_regiao'], values='TOTAL', names='REGIAO_GEOGRAFICA', hole=0.4)
+    
+    fig_sexo = px.pie(agregados['por_sexo'], values='TOTAL', names='SEXO')
+    
+    fig_idade = px.bar(agregados['por_faixa_idade'], x='TOTAL', y='FAIXA_IDADE', orientation='h')
+    fig_idade.update_layout(yaxis={'categoryorder':'total ascending'})
+    
+    fig_nat_idade = px.bar(agregados['por_faixa_natureza'], x='FAIXA_IDADE', y='TOTAL', color='NATUREZA', barmode='stack')
+    fig_nat_idade.update_layout(height=400)
+    
+    return {
+        'por_ano': fig_ano.to_plotly_json(),
+        'por_mes': fig_mes.to_plotly_json(),
+        'por_ano_natureza': reamostrar_figura(fig_nat).to_plotly_json(),
+        'por_municipio': fig_mun.to_plotly_json(),
+        'por_regiao': fig_reg.to_plotly_json(),
+        'por_sexo': fig_sexo.to_plotly_json(),
+        'por_faixa_idade': fig_idade.to_plotly_json(),
+        'por_faixa_natureza': fig_nat_idade.to_plotly_json()
+    }
+
+
+@st.cache_data(show_spinner=False)
+def calcular_mapa_estupro(arquivo, sheet, filtros, ano_mapa, top_n):
+    """Top N de municípios do mapa, calculado uma única vez por combinação de filtros"""
+    df = carregar_dados_estupro(arquivo, sheet)
+    return agregar_mapa_calor(_filtrar_estupro(df, filtros), 'MUNICIPIO', 'TOTAL', ano_mapa, None, top_n)
+
+
+@st.cache_data(show_spinner=False)
+def gerar_csv_estupro(arquivo, sheet, filtros):
+    """Serializa os dados filtrados em CSV uma única vez por combinação de filtros"""
+    df = carregar_dados_estupro(arquivo, sheet)
+    df_filtrado = _filtrar_estupro(df, filtros).drop(columns=COLUNAS_INTERNAS_ESTUPRO)
+    return exportar_csv(df_filtrado)
+
+
+@st.cache_data(show_spinner=False)
+def gerar_parquet_estupro(arquivo, sheet, filtros):
+    """Serializa os dados filtrados em Parquet uma única vez por combinação de filtros"""
+    df = carregar_dados_estupro(arquivo, sheet)
+    df_filtrado = _filtrar_estupro(df, filtros).drop(columns=COLUNAS_INTERNAS_ESTUPRO)
+    return exportar_parquet(df_filtrado)
 
 
 def render(base_info):
@@ -44,58 +187,50 @@ def render(base_info):
     st.markdown(f"**Período:** {base_info['periodo']} | **Total de registros:** {len(df):,}")
     
     # Criar filtros com mapeamento de colunas
-    mapeamento = {
-        'municipio': 'MUNICIPIO',
-        'regiao': 'REGIAO_GEOGRAFICA',
-        'sexo': 'SEXO',
-        'ano': 'ANO'
-    }
-    filtros = criar_filtros_padrao(df, mapeamento)
+    opcoes = obter_opcoes_estupro(base_info['arquivo'], base_info['sheet'])
+    filtros = criar_filtros_padrao(df, opcoes)
     
     # Filtros adicionais especÃ­ficos
     st.sidebar.markdown("---")
-    naturezas = ['Todas'] + sorted(df['NATUREZA'].unique().tolist())
+    naturezas = ['Todas'] + opcoes['NATUREZA']
     filtros['naturezas'] = st.sidebar.multiselect("Natureza do Crime", options=naturezas, default=['Todas'])
     
-    faixas_idade = ['Todas'] + sorted(df['FAIXA_IDADE'].unique().tolist())
+    faixas_idade = ['Todas'] + opcoes['FAIXA_IDADE']
     filtros['faixas_idade'] = st.sidebar.multiselect("Faixa EtÃ¡ria", options=faixas_idade, default=['Todas'])
     
-    # Aplicar filtros
-    df_filtrado = aplicar_filtros(df, filtros, mapeamento)
-    
-    # Aplicar filtros especÃ­ficos
-    if 'Todas' not in filtros['naturezas'] and len(filtros['naturezas']) > 0:
-        df_filtrado = df_filtrado[df_filtrado['NATUREZA'].isin(filtros['naturezas'])]
+    st.sidebar.markdown("---")
+    render_mode = escolher_modo_renderizacao()
     
-    if 'Todas' not in filtros['faixas_idade'] and len(filtros['faixas_idade']) > 0:
-        df_filtrado = df_filtrado[df_filtrado['FAIXA_IDADE'].isin(filtros['faixas_idade'])]
+    # Aplicar filtros
+    agregados = calcular_agregados_estupro(base_info['arquivo'], base_info['sheet'], filtros)
+    figuras = montar_figuras_estupro(base_info['arquivo'], base_info['sheet'], filtros, render_mode)
     
     # MÃ©tricas
     st.header("Indicadores Principais")
     col1, col2, col3, col4, col5 = st.columns(5)
     
     with col1:
-        st.metric("Total de Casos", f"{df_filtrado['TOTAL'].sum():,}")
+        st.metric("Total de Casos", f"{agregados['total']:,}")
     
     with col2:
-        media = df_filtrado.groupby('ANO')['TOTAL'].sum().mean()
+        media = agregados['por_ano']['TOTAL'].mean()
         st.metric("Média Anual", f"{media:.0f}")
     
     with col3:
-        munic = df_filtrado['MUNICIPIO'].nunique()
+        munic = agregados['municipios']
         st.metric("Municípios", f"{munic}")
     
+    total = agregados['total']
+    
     with col4:
-        if 'SEXO' in df_filtrado.columns:
-            fem = df_filtrado[df_filtrado['SEXO'].str.contains('FEM', case=False, na=False)]
-            perc = (fem['TOTAL'].sum() / df_filtrado['TOTAL'].sum() * 100) if df_filtrado['TOTAL'].sum() > 0 else 0
+        if 'SEXO' in df.columns:
+            perc = (agregados['total_feminino'] / total * 100) if total > 0 else 0
             st.metric("% Feminino", f"{perc:.1f}%")
         else:
-            st.metric("Casos", f"{len(df_filtrado):,}")
+            st.metric("Casos", f"{agregados['registros']:,}")
     
     with col5:
-        menor = df_filtrado[df_filtrado['FAIXA_IDADE'].str.contains('00-11|12-17', case=False, na=False)]
-        perc_menor = (menor['TOTAL'].sum() / df_filtrado['TOTAL'].sum() * 100) if df_filtrado['TOTAL'].sum() > 0 else 0
+        perc_menor = (agregados['total_menores'] / total * 100) if total > 0 else 0
         st.metric("% Menores", f"{perc_menor:.1f}%")
     
     st.markdown("---")
@@ -109,61 +244,42 @@ def render(base_info):
     ])
     
     with tab1:
-        render_evolucao(df_filtrado)
+        render_evolucao(figuras)
     
     with tab2:
-        render_geografica(df_filtrado)
+        render_geografica(base_info, filtros, agregados, figuras)
     
     with tab3:
-        render_perfil(df_filtrado)
+        render_perfil(figuras)
     
     with tab4:
-        render_detalhada(df_filtrado)
+        render_detalhada(base_info, filtros, agregados)
 
 
-def render_evolucao(df):
+@st.fragment
+def render_evolucao(figuras):
     """Renderiza evolução temporal"""
     st.header("Evolução Temporal")
     
     col1, col2 = st.columns(2)
     
     with col1:
-        df_ano = df.groupby('ANO')['TOTAL'].sum().reset_index()
-        fig = px.line(df_ano, x='ANO', y='TOTAL', markers=True,
-                     title='Evolução Anual de Casos')
-        fig.update_traces(line_color='#ff7f0e', line_width=3)
-        st.plotly_chart(fig, use_container_width=True)
+        st.plotly_chart(go.Figure(figuras['por_ano']), use_container_width=True)
     
     with col2:
-        df_mes = df.groupby('MES')['TOTAL'].sum().reset_index()
-        df_mes['MES_NOME'] = df_mes['MES'].apply(lambda x: calendar.month_abbr[int(x)])
-        fig = px.bar(df_mes, x='MES_NOME', y='TOTAL', title='Distribuição Mensal')
-        st.plotly_chart(fig, use_container_width=True)
+        st.plotly_chart(go.Figure(figuras['por_mes']), use_container_width=True)
     
     # Por natureza ao longo do tempo
     st.subheader("Evolução por Natureza do Crime")
-    df_nat = df.groupby(['ANO', 'NATUREZA'])['TOTAL'].sum().reset_index()
-    fig = px.line(df_nat, x='ANO', y='TOTAL', color='NATUREZA', markers=True)
-    fig.update_layout(height=500)
-    st.plotly_chart(fig, use_container_width=True)
+    st.plotly_chart(go.Figure(figuras['por_ano_natureza']), use_container_width=True)
 
 
-def render_geografica(df):
+@st.fragment
+def render_geografica(base_info, filtros, agregados, figuras):
     """Renderiza análise geográfica"""
     st.header("Análise Geográfica")
     
-    st.subheader("🗺️ Mapa de Calor")
-    col1, col2 = st.columns([3, 1])
-    
-    with col2:
-        anos = sorted(df['ANO'].unique())
-        ano = st.selectbox("Ano", ['Todos'] + list(anos))
-        top_n = st.slider("Top N municÃ­pios", 5, 30, 15)
-    
-    with col1:
-        ano_filtro = None if ano == 'Todos' else ano
-        mapa = criar_mapa_calor(df, 'MUNICIPIO', 'TOTAL', ano_filtro, None, top_n)
-        st_folium(mapa, width=700, height=500)
+    render_mapa(base_info, filtros, agregados['por_ano']['ANO'].tolist())
     
     st.markdown("---")
     
@@ -171,19 +287,31 @@ def render_geografica(df):
     
     with col1:
         st.subheader("Top 15 MunicÃ­pios")
-        df_mun = df.groupby('MUNICIPIO')['TOTAL'].sum().sort_values(ascending=False).head(15).reset_index()
-        fig = px.bar(df_mun, x='TOTAL', y='MUNICIPIO', orientation='h')
-        fig.update_layout(yaxis={'categoryorder':'total ascending'})
-        st.plotly_chart(fig, use_container_width=True)
+        st.plotly_chart(go.Figure(figuras['por_municipio']), use_container_width=True)
     
     with col2:
         st.subheader("Por Região")
-        df_reg = df.groupby('REGIAO_GEOGRAFICA')['TOTAL'].sum().reset_index()
-        fig = px.pie(df_reg, values='TOTAL', names='REGIAO_GEOGRAFICA', hole=0.4)
-        st.plotly_chart(fig, use_container_width=True)
+        st.plotly_chart(go.Figure(figuras['por_regiao']), use_container_width=True)
+
+
+@st.fragment
+def render_mapa(base_info, filtros, anos):
+    """Renderiza o mapa; mudar o ano ou o Top N só reexecuta este bloco"""
+    st.subheader("🗺️ Mapa de Calor")
+    col1, col2 = st.columns([3, 1])
+    
+    with col2:
+        ano = st.selectbox("Ano", ['Todos'] + list(anos))
+        top_n = st.slider("Top N municÃ­pios", 5, 30, 15)
+    
+    with col1:
+        ano_filtro = None if ano == 'Todos' else ano
+        df_top = calcular_mapa_estupro(base_info['arquivo'], base_info['sheet'], filtros, ano_filtro, top_n)
+        components.html(html_mapa_calor(df_top, 'MUNICIPIO', 'TOTAL'), width=700, height=500)
 
 
-def render_perfil(df):
+@st.fragment
+def render_perfil(figuras):
     """Renderiza perfil das vítimas"""
     st.header("Perfil das Vítimas")
     
@@ -191,26 +319,19 @@ def render_perfil(df):
     
     with col1:
         st.subheader("Por Sexo")
-        df_sexo = df.groupby('SEXO')['TOTAL'].sum().reset_index()
-        fig = px.pie(df_sexo, values='TOTAL', names='SEXO')
-        st.plotly_chart(fig, use_container_width=True)
+        st.plotly_chart(go.Figure(figuras['por_sexo']), use_container_width=True)
     
     with col2:
         st.subheader("Por Faixa Etária")
-        df_idade = df.groupby('FAIXA_IDADE')['TOTAL'].sum().sort_values(ascending=False).reset_index()
-        fig = px.bar(df_idade, x='TOTAL', y='FAIXA_IDADE', orientation='h')
-        fig.update_layout(yaxis={'categoryorder':'total ascending'})
-        st.plotly_chart(fig, use_container_width=True)
+        st.plotly_chart(go.Figure(figuras['por_faixa_idade']), use_container_width=True)
     
     # Natureza por faixa etária
     st.subheader("Natureza do Crime por Faixa Etária")
-    df_nat_idade = df.groupby(['FAIXA_IDADE', 'NATUREZA'])['TOTAL'].sum().reset_index()
-    fig = px.bar(df_nat_idade, x='FAIXA_IDADE', y='TOTAL', color='NATUREZA', barmode='stack')
-    fig.update_layout(height=400)
-    st.plotly_chart(fig, use_container_width=True)
+    st.plotly_chart(go.Figure(figuras['por_faixa_natureza']), use_container_width=True)
 
 
-def render_detalhada(df):
+@st.fragment
+def render_detalhada(base_info, filtros, agregados):
     """Renderiza análise detalhada"""
     st.header("Análise Detalhada")
     
@@ -218,22 +339,29 @@ def render_detalhada(df):
     
     with col1:
         st.subheader("Ranking de Municípios")
-        df_rank = df.groupby('MUNICIPIO')['TOTAL'].sum().sort_values(ascending=False).head(20).reset_index()
+        df_rank = agregados['por_municipio'].head(20)
         df_rank.columns = ['Município', 'Total de Casos']
         st.dataframe(df_rank, use_container_width=True)
     
     with col2:
         st.subheader("Por Natureza do Crime")
-        df_nat = df.groupby('NATUREZA')['TOTAL'].sum().sort_values(ascending=False).reset_index()
+        df_nat = agregados['por_natureza'].copy()
         df_nat.columns = ['Natureza', 'Total']
         st.dataframe(df_nat, use_container_width=True)
     
     # Download
     st.subheader("Exportar Dados")
-    csv = df.to_csv(index=False).encode('utf-8')
-    st.download_button("📥 Download CSV", data=csv,
-                      file_name=f'estupro_pe_{datetime.now().strftime("%Y%m%d")}.csv',
-                      mime='text/csv')
+    parquet = gerar_parquet_estupro(base_info['arquivo'], base_info['sheet'], filtros)
+    st.download_button("📥 Download Parquet", data=parquet,
+                      file_name=f'estupro_pe_{datetime.now().strftime("%Y%m%d")}.parquet',
+                      mime='application/octet-stream')
+    
+    # CSV só é gerado quando pedido
+    if st.checkbox("Exportar também em CSV"):
+        csv = gerar_csv_estupro(base_info['arquivo'], base_info['sheet'], filtros)
+        st.download_button("📥 Download CSV", data=csv,
+                          file_name=f'estupro_pe_{datetime.now().strftime("%Y%m%d")}.csv',
+                          mime='text/csv')
 
 
 
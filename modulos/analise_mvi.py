@@ -2,30 +2,70 @@
 Módulo de análise para Mortes Violentas Intencionais (MVI)
 """
 import streamlit as st
-import pandas as pd
+import streamlit.components.v1 as components
 import plotly.express as px
 import plotly.graph_objects as go
 import calendar
+import polars as pl
 from datetime import datetime
-from streamlit_folium import st_folium
-from .utils import criar_mapa_calor, criar_filtros_padrao, aplicar_filtros, exibir_metricas_principais
+from .utils import (
+    agregar_mapa_calor, html_mapa_calor, criar_filtros_padrao, mascara_filtros, mascara_valores,
+    exibir_metricas_principais, carregar_dados, somar_por_grupos, listar_opcoes, nomear_meses,
+    reamostrar_figura, escolher_modo_renderizacao, exportar_csv, exportar_parquet, COLUNAS_INTERNAS, MES_ABBR
+)
+
+
+# Colunas lidas da planilha, que já seguem os nomes padronizados
+COLUNAS_PLANILHA = tuple((col, col) for col in (
+    'MUNICIPIO', 'REGIAO_GEOGRAFICA', 'SEXO', 'NATUREZA JURIDICA', 'DATA', 'ANO', 'IDADE', 'TOTAL DE VITIMAS'
+))
 
 
-@st.cache_data
 def carregar_dados_mvi(arquivo, sheet):
-    """Carrega e prepara os dados de MVI"""
-    df = pd.read_excel(arquivo, sheet_name=sheet)
-    
-    # Garantir que DATA seja datetime
-    df['DATA'] = pd.to_datetime(df['DATA'])
-    df['MES'] = df['DATA'].dt.month
-    df['MES_NOME'] = df['DATA'].dt.month_name()
-    df['DIA'] = df['DATA'].dt.day
+    """Carrega e prepara os dados de MVI (as colunas da planilha já seguem o padrão)"""
+    # Na planilha de MVI a região não informada vem como 0
+    return carregar_dados(arquivo, sheet, COLUNAS_PLANILHA, regiao_zero_nao_informada=True)
+
+
+@st.cache_data(show_spinner=False)
+def obter_opcoes_mvi(arquivo, sheet):
+    """Valores disponíveis nos filtros, calculados uma única vez por base"""
+    df = carregar_dados_mvi(arquivo, sheet)
+    return listar_opcoes(df, ['ANO', 'REGIAO_GEOGRAFICA', 'MUNICIPIO', 'SEXO', 'IDADE', 'NATUREZA JURIDICA'])
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def filtrar_dados_mvi(arquivo, sheet, filtros):
+    """Aplica os filtros uma única vez por combinação, reaproveitada ao trocar de aba"""
+    df = carregar_dados_mvi(arquivo, sheet)
+    mascara = mascara_filtros(df, filtros)
     
-    # Limpar região geográfica
-    df['REGIAO_GEOGRAFICA'] = df['REGIAO_GEOGRAFICA'].replace(0, 'NÃO INFORMADO')
+    # Filtro de natureza entra na mesma máscara
+    if 'Todas' not in filtros['naturezas'] and len(filtros['naturezas']) > 0:
+        mascara &= mascara_valores(df['NATUREZA JURIDICA'], filtros['naturezas'])
     
-    return df
+    return df[mascara]
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def gerar_csv_mvi(arquivo, sheet, filtros):
+    """Serializa os dados filtrados em CSV uma única vez por combinação de filtros"""
+    df_filtrado = filtrar_dados_mvi(arquivo, sheet, filtros).drop(columns=COLUNAS_INTERNAS)
+    return exportar_csv(df_filtrado)
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def gerar_parquet_mvi(arquivo, sheet, filtros):
+    """Serializa os dados filtrados em Parquet uma única vez por combinação de filtros"""
+    df_filtrado = filtrar_dados_mvi(arquivo, sheet, filtros).drop(columns=COLUNAS_INTERNAS)
+    return exportar_parquet(df_filtrado)
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def calcular_mapa_mvi(arquivo, sheet, filtros, ano_mapa, mes_mapa, top_n):
+    """Top N de municípios do mapa, calculado uma única vez por combinação de filtros"""
+    df = filtrar_dados_mvi(arquivo, sheet, filtros)
+    return agregar_mapa_calor(df, 'MUNICIPIO', 'TOTAL DE VITIMAS', ano_mapa, mes_mapa, top_n)
 
 
 def render(base_info):
@@ -40,19 +80,19 @@ def render(base_info):
     st.markdown(f"**Período:** {base_info['periodo']} | **Total de registros:** {len(df):,}")
     
     # Criar filtros
-    filtros = criar_filtros_padrao(df)
+    opcoes = obter_opcoes_mvi(base_info['arquivo'], base_info['sheet'])
+    filtros = criar_filtros_padrao(df, opcoes)
     
     # Adicionar filtro específico de natureza jurídica
     st.sidebar.markdown("---")
-    naturezas = ['Todas'] + sorted(df['NATUREZA JURIDICA'].unique().tolist())
+    naturezas = ['Todas'] + opcoes['NATUREZA JURIDICA']
     filtros['naturezas'] = st.sidebar.multiselect("Natureza Jurídica", options=naturezas, default=['Todas'])
     
-    # Aplicar filtros
-    df_filtrado = aplicar_filtros(df, filtros)
+    st.sidebar.markdown("---")
+    render_mode = escolher_modo_renderizacao()
     
-    # Aplicar filtro de natureza
-    if 'Todas' not in filtros['naturezas'] and len(filtros['naturezas']) > 0:
-        df_filtrado = df_filtrado[df_filtrado['NATUREZA JURIDICA'].isin(filtros['naturezas'])]
+    # Aplicar filtros
+    df_filtrado = filtrar_dados_mvi(base_info['arquivo'], base_info['sheet'], filtros)
     
     # Métricas principais
     st.header("📊 Indicadores Principais")
@@ -70,40 +110,60 @@ def render(base_info):
     ])
     
     with tab1:
-        render_evolucao_temporal(df_filtrado)
+        render_evolucao_temporal(base_info, filtros, render_mode)
     
     with tab2:
-        render_analise_geografica(df_filtrado, filtros)
+        render_analise_geografica(df_filtrado, base_info, filtros)
     
     with tab3:
-        render_perfil_vitimas(df_filtrado)
+        render_perfil_vitimas(df_filtrado, render_mode)
     
     with tab4:
-        render_natureza_juridica(df_filtrado)
+        render_natureza_juridica(df_filtrado, render_mode)
     
     with tab5:
-        render_analise_detalhada(df_filtrado, df, filtros)
+        render_analise_detalhada(df_filtrado, base_info, filtros)
 
 
-def render_evolucao_temporal(df):
+@st.cache_data(show_spinner=False, max_entries=16)
+def calcular_evolucao_mvi(arquivo, sheet, filtros):
+    """Totais por ano, por mês e a matriz ano x mês do heatmap, uma única vez por combinação de filtros"""
+    df = filtrar_dados_mvi(arquivo, sheet, filtros)
+    
+    # Uma única passada por ano e mês; os totais anuais e mensais saem dela
+    df_ano_mes = somar_por_grupos(df, 'TOTAL DE VITIMAS', {'por_ano_mes': (['ANO', 'MES'], False)})['por_ano_mes']
+    
+    df_pivot = df_ano_mes.pivot(index='ANO', columns='MES', values='TOTAL DE VITIMAS').fillna(0)
+    df_pivot.columns = MES_ABBR[df_pivot.columns.to_numpy()]
+    
+    return {
+        'por_ano': df_ano_mes.groupby('ANO', observed=True, sort=False)['TOTAL DE VITIMAS'].sum().sort_index().reset_index(),
+        'por_mes': df_ano_mes.groupby('MES', observed=True, sort=False)['TOTAL DE VITIMAS'].sum().sort_index().reset_index(),
+        'pivot_ano_mes': df_pivot
+    }
+
+
+@st.fragment
+def render_evolucao_temporal(base_info, filtros, render_mode):
     """Renderiza análises de evolução temporal"""
     st.header("Evolução Temporal das MVI")
     
+    agregados = calcular_evolucao_mvi(base_info['arquivo'], base_info['sheet'], filtros)
+    
     col1, col2 = st.columns(2)
     
     with col1:
         st.subheader("Vítimas por Ano")
-        df_ano = df.groupby('ANO')['TOTAL DE VITIMAS'].sum().reset_index()
-        fig = px.line(df_ano, x='ANO', y='TOTAL DE VITIMAS', markers=True,
-                      title='Evolução Anual das Vítimas de MVI')
+        fig = px.line(agregados['por_ano'], x='ANO', y='TOTAL DE VITIMAS', markers=True,
+                      title='Evolução Anual das Vítimas de MVI', render_mode=render_mode)
         fig.update_traces(line_color='#d62728', line_width=3)
         fig.update_layout(height=400)
-        st.plotly_chart(fig, use_container_width=True)
+        st.plotly_chart(reamostrar_figura(fig), use_container_width=True)
     
     with col2:
         st.subheader("Distribuição por Mês")
-        df_mes = df.groupby('MES')['TOTAL DE VITIMAS'].sum().reset_index()
-        df_mes['MES_NOME'] = df_mes['MES'].apply(lambda x: calendar.month_abbr[int(x)])
+        df_mes = agregados['por_mes']
+        df_mes['MES_NOME'] = nomear_meses(df_mes['MES'])
         fig = px.bar(df_mes, x='MES_NOME', y='TOTAL DE VITIMAS',
                      title='Distribuição Mensal das Vítimas')
         fig.update_traces(marker_color='#ff7f0e')
@@ -112,9 +172,7 @@ def render_evolucao_temporal(df):
     
     # Heatmap
     st.subheader("Heatmap: Vítimas por Ano e Mês")
-    df_heatmap = df.groupby(['ANO', 'MES'])['TOTAL DE VITIMAS'].sum().reset_index()
-    df_pivot = df_heatmap.pivot(index='ANO', columns='MES', values='TOTAL DE VITIMAS').fillna(0)
-    df_pivot.columns = [calendar.month_abbr[int(i)] for i in df_pivot.columns]
+    df_pivot = agregados['pivot_ano_mes']
     
     fig = px.imshow(df_pivot, labels=dict(x="Mês", y="Ano", color="Vítimas"),
                     x=df_pivot.columns, y=df_pivot.index, aspect="auto",
@@ -123,29 +181,17 @@ def render_evolucao_temporal(df):
     st.plotly_chart(fig, use_container_width=True)
 
 
-def render_analise_geografica(df, filtros):
+@st.fragment
+def render_analise_geografica(df, base_info, filtros):
     """Renderiza análises geográficas"""
     st.header("Análise Geográfica")
     
-    # Mapa
-    st.subheader("🗺️ Mapa de Calor - MVI por Município")
-    
-    col_map1, col_map2 = st.columns([3, 1])
-    
-    with col_map2:
-        st.write("**Controles do Mapa:**")
-        anos = sorted(df['ANO'].unique())
-        map_ano = st.selectbox("Ano", ['Todos'] + list(anos), key='map_ano_mvi')
-        map_mes = st.selectbox("Mês", ['Todos'] + list(range(1, 13)), key='map_mes_mvi',
-                             format_func=lambda x: 'Todos' if x == 'Todos' else calendar.month_name[x])
-        top_n = st.slider("Top N municípios", 5, 50, 20, key='top_n_mvi')
+    agregados = somar_por_grupos(df, 'TOTAL DE VITIMAS', {
+        'por_municipio': ('MUNICIPIO', True),
+        'por_regiao': ('REGIAO_GEOGRAFICA', False)
+    })
     
-    with col_map1:
-        ano_filtro = None if map_ano == 'Todos' else map_ano
-        mes_filtro = None if map_mes == 'Todos' else map_mes
-        
-        mapa = criar_mapa_calor(df, 'MUNICIPIO', 'TOTAL DE VITIMAS', ano_filtro, mes_filtro, top_n)
-        st_folium(mapa, width=700, height=500)
+    render_mapa(base_info, filtros, agregados['por_municipio'])
     
     st.markdown("---")
     
@@ -153,7 +199,7 @@ def render_analise_geografica(df, filtros):
     
     with col1:
         st.subheader("Top 15 Municípios")
-        df_mun = df.groupby('MUNICIPIO')['TOTAL DE VITIMAS'].sum().sort_values(ascending=False).head(15).reset_index()
+        df_mun = agregados['por_municipio'].head(15)
         fig = px.bar(df_mun, x='TOTAL DE VITIMAS', y='MUNICIPIO', orientation='h')
         fig.update_traces(marker_color='#1f77b4')
         fig.update_layout(height=500, yaxis={'categoryorder':'total ascending'})
@@ -161,29 +207,63 @@ def render_analise_geografica(df, filtros):
     
     with col2:
         st.subheader("Por Região")
-        df_reg = df.groupby('REGIAO_GEOGRAFICA')['TOTAL DE VITIMAS'].sum().reset_index()
-        fig = px.pie(df_reg, values='TOTAL DE VITIMAS', names='REGIAO_GEOGRAFICA', hole=0.4)
+        fig = px.pie(agregados['por_regiao'], values='TOTAL DE VITIMAS', names='REGIAO_GEOGRAFICA', hole=0.4)
         fig.update_layout(height=500)
         st.plotly_chart(fig, use_container_width=True)
 
 
-def render_perfil_vitimas(df):
+@st.fragment
+def render_mapa(base_info, filtros, por_municipio):
+    """Renderiza o mapa de calor; mudar o ano, o mês ou o Top N só reexecuta este bloco"""
+    st.subheader("🗺️ Mapa de Calor - MVI por Município")
+    
+    col_map1, col_map2 = st.columns([3, 1])
+    
+    with col_map2:
+        st.write("**Controles do Mapa:**")
+        # Anos do recorte atual, já somados e em cache na evolução temporal
+        anos = calcular_evolucao_mvi(base_info['arquivo'], base_info['sheet'], filtros)['por_ano']['ANO'].tolist()
+        map_ano = st.selectbox("Ano", ['Todos'] + anos, key='map_ano_mvi')
+        map_mes = st.selectbox("Mês", ['Todos'] + list(range(1, 13)), key='map_mes_mvi',
+                             format_func=lambda x: 'Todos' if x == 'Todos' else calendar.month_name[x])
+        top_n = st.slider("Top N municípios", 5, 50, 20, key='top_n_mvi')
+    
+    with col_map1:
+        ano_filtro = None if map_ano == 'Todos' else map_ano
+        mes_filtro = None if map_mes == 'Todos' else map_mes
+        
+        if ano_filtro is None and mes_filtro is None:
+            # Sem recorte de ano/mês o top N é o mesmo ranking já agregado
+            df_top = por_municipio.head(top_n)
+        else:
+            df_top = calcular_mapa_mvi(base_info['arquivo'], base_info['sheet'], filtros,
+                                       ano_filtro, mes_filtro, top_n)
+        components.html(html_mapa_calor(df_top, 'MUNICIPIO', 'TOTAL DE VITIMAS'), width=700, height=500)
+
+
+@st.fragment
+def render_perfil_vitimas(df, render_mode):
     """Renderiza análises de perfil das vítimas"""
     st.header("Perfil das Vítimas")
     
+    df_ano_sexo = somar_por_grupos(df, 'TOTAL DE VITIMAS', {'por_ano_sexo': (['ANO', 'SEXO'], False)})['por_ano_sexo']
+    agregados = {
+        'por_sexo': df_ano_sexo.groupby('SEXO', observed=True, sort=False)['TOTAL DE VITIMAS'].sum().reset_index(),
+        'por_ano_sexo': df_ano_sexo
+    }
+    
     col1, col2 = st.columns(2)
     
     with col1:
         st.subheader("Por Sexo")
-        df_sexo = df.groupby('SEXO')['TOTAL DE VITIMAS'].sum().reset_index()
-        fig = px.pie(df_sexo, values='TOTAL DE VITIMAS', names='SEXO')
+        fig = px.pie(agregados['por_sexo'], values='TOTAL DE VITIMAS', names='SEXO')
         st.plotly_chart(fig, use_container_width=True)
     
     with col2:
         st.subheader("Evolução por Sexo")
-        df_sexo_ano = df.groupby(['ANO', 'SEXO'])['TOTAL DE VITIMAS'].sum().reset_index()
-        fig = px.line(df_sexo_ano, x='ANO', y='TOTAL DE VITIMAS', color='SEXO', markers=True)
-        st.plotly_chart(fig, use_container_width=True)
+        fig = px.line(agregados['por_ano_sexo'], x='ANO', y='TOTAL DE VITIMAS', color='SEXO', markers=True,
+                      render_mode=render_mode)
+        st.plotly_chart(reamostrar_figura(fig), use_container_width=True)
     
     # Idade
     st.subheader("Distribuição por Idade")
@@ -196,23 +276,27 @@ def render_perfil_vitimas(df):
         st.plotly_chart(fig, use_container_width=True)
     
     with col2:
-        bins = [0, 12, 17, 24, 29, 39, 49, 59, 100]
-        labels = ['0-12', '13-17', '18-24', '25-29', '30-39', '40-49', '50-59', '60+']
-        df['FAIXA_ETARIA'] = pd.cut(df['IDADE'], bins=bins, labels=labels, include_lowest=True)
-        df_faixa = df.groupby('FAIXA_ETARIA')['TOTAL DE VITIMAS'].sum().reset_index()
+        df_faixa = df.groupby('FAIXA_ETARIA', observed=True, sort=False)['TOTAL DE VITIMAS'].sum().sort_index().reset_index()
         fig = px.bar(df_faixa, x='FAIXA_ETARIA', y='TOTAL DE VITIMAS')
         st.plotly_chart(fig, use_container_width=True)
 
 
-def render_natureza_juridica(df):
+@st.fragment
+def render_natureza_juridica(df, render_mode):
     """Renderiza análises por natureza jurídica"""
     st.header("Análise por Natureza Jurídica")
     
+    df_nat_ano = somar_por_grupos(df, 'TOTAL DE VITIMAS', {
+        'por_ano_natureza': (['ANO', 'NATUREZA JURIDICA'], False)
+    })['por_ano_natureza']
+    # Barras e pizza usam o mesmo total por natureza, derivado da série anual
+    df_nat = (df_nat_ano.groupby('NATUREZA JURIDICA', observed=True, sort=False)['TOTAL DE VITIMAS'].sum()
+              .sort_values(ascending=False).reset_index())
+    
     col1, col2 = st.columns(2)
     
     with col1:
         st.subheader("Distribuição")
-        df_nat = df.groupby('NATUREZA JURIDICA')['TOTAL DE VITIMAS'].sum().sort_values(ascending=False).reset_index()
         fig = px.bar(df_nat, x='TOTAL DE VITIMAS', y='NATUREZA JURIDICA', orientation='h')
         fig.update_layout(yaxis={'categoryorder':'total ascending'})
         st.plotly_chart(fig, use_container_width=True)
@@ -224,44 +308,62 @@ def render_natureza_juridica(df):
     
     # Evolução
     st.subheader("Evolução Temporal por Natureza")
-    df_nat_ano = df.groupby(['ANO', 'NATUREZA JURIDICA'])['TOTAL DE VITIMAS'].sum().reset_index()
-    fig = px.line(df_nat_ano, x='ANO', y='TOTAL DE VITIMAS', color='NATUREZA JURIDICA', markers=True)
+    fig = px.line(df_nat_ano, x='ANO', y='TOTAL DE VITIMAS', color='NATUREZA JURIDICA', markers=True,
+                  render_mode=render_mode)
     fig.update_layout(height=500)
-    st.plotly_chart(fig, use_container_width=True)
+    st.plotly_chart(reamostrar_figura(fig), use_container_width=True)
 
 
-def render_analise_detalhada(df_filtrado, df_original, filtros):
+@st.fragment
+def render_analise_detalhada(df_filtrado, base_info, filtros):
     """Renderiza análises detalhadas e exportação"""
     st.header("Análise Detalhada")
     
+    # Uma única passada por (região, município); os dois rankings são somados a partir dela
+    base = (
+        pl.from_pandas(df_filtrado[['MUNICIPIO', 'REGIAO_GEOGRAFICA', 'IDADE', 'TOTAL DE VITIMAS']])
+        .group_by(['REGIAO_GEOGRAFICA', 'MUNICIPIO'])
+        .agg([
+            pl.col('TOTAL DE VITIMAS').sum().alias('Total'),
+            pl.col('IDADE').sum().alias('_SOMA_IDADE'),
+            pl.col('IDADE').count().alias('_N_IDADE')
+        ])
+    )
+    total = pl.col('Total').sum()
+    idade_media = (pl.col('_SOMA_IDADE').sum() / pl.col('_N_IDADE').sum()).round(1).alias('Idade Média')
+    
+    df_rank = (
+        base.drop_nulls('MUNICIPIO').group_by('MUNICIPIO').agg([total, idade_media])
+        .sort('Total', descending=True).head(20)
+        .rename({'MUNICIPIO': 'Município'})
+    )
+    df_stats = (
+        base.drop_nulls('REGIAO_GEOGRAFICA').group_by('REGIAO_GEOGRAFICA')
+        .agg([total, idade_media, pl.col('MUNICIPIO').count().alias('Municípios')])
+        .sort('Total', descending=True)
+        .rename({'REGIAO_GEOGRAFICA': 'Região'})
+    )
+    
     col1, col2 = st.columns(2)
     
     with col1:
         st.subheader("Ranking de Municípios")
-        df_rank = df_filtrado.groupby('MUNICIPIO').agg({
-            'TOTAL DE VITIMAS': 'sum',
-            'IDADE': 'mean'
-        }).reset_index()
-        df_rank.columns = ['Município', 'Total', 'Idade Média']
-        df_rank = df_rank.sort_values('Total', ascending=False).head(20)
-        df_rank['Idade Média'] = df_rank['Idade Média'].round(1)
-        st.dataframe(df_rank, use_container_width=True)
+        st.dataframe(df_rank.to_pandas(), use_container_width=True)
     
     with col2:
         st.subheader("Por Região")
-        df_stats = df_filtrado.groupby('REGIAO_GEOGRAFICA').agg({
-            'TOTAL DE VITIMAS': 'sum',
-            'IDADE': 'mean',
-            'MUNICIPIO': 'nunique'
-        }).reset_index()
-        df_stats.columns = ['Região', 'Total', 'Idade Média', 'Municípios']
-        df_stats = df_stats.sort_values('Total', ascending=False)
-        df_stats['Idade Média'] = df_stats['Idade Média'].round(1)
-        st.dataframe(df_stats, use_container_width=True)
+        st.dataframe(df_stats.to_pandas(), use_container_width=True)
     
     # Download
     st.subheader("Exportar Dados")
-    csv = df_filtrado.to_csv(index=False).encode('utf-8')
-    st.download_button("📥 Download CSV", data=csv,
-                      file_name=f'mvi_pe_{datetime.now().strftime("%Y%m%d")}.csv',
-                      mime='text/csv')
+    parquet = gerar_parquet_mvi(base_info['arquivo'], base_info['sheet'], filtros)
+    st.download_button("📥 Download Parquet", data=parquet,
+                      file_name=f'mvi_pe_{datetime.now().strftime("%Y%m%d")}.parquet',
+                      mime='application/octet-stream')
+    
+    # CSV só é gerado quando pedido
+    if st.checkbox("Exportar também em CSV"):
+        csv = gerar_csv_mvi(base_info['arquivo'], base_info['sheet'], filtros)
+        st.download_button("📥 Download CSV", data=csv,
+                          file_name=f'mvi_pe_{datetime.now().strftime("%Y%m%d")}.csv',
+                          mime='text/csv')
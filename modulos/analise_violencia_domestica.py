@@ -2,26 +2,65 @@
 MÃ³dulo de anÃ¡lise para ViolÃªncia DomÃ©stica
 """
 import streamlit as st
-import pandas as pd
+import streamlit.components.v1 as components
 import plotly.express as px
-import calendar
 from datetime import datetime
-from .utils import criar_mapa_calor
+from .utils import (
+    agregar_mapa_calor, html_mapa_calor, carregar_dados, somar_por_grupos, mascara_valores, listar_opcoes,
+    contar_distintos, nomear_meses, reamostrar_figura, escolher_modo_renderizacao, exportar_csv, exportar_parquet,
+    COLUNAS_INTERNAS
+)
+
+
+# Colunas lidas da planilha e seus nomes padronizados
+COLUNAS_PLANILHA = (
+    ('MUNICÍPIO DO FATO', 'MUNICIPIO'),
+    ('REGIAO GEOGRÁFICA', 'REGIAO_GEOGRAFICA'),
+    ('NATUREZA', 'NATUREZA'),
+    ('DATA DO FATO', 'DATA'),
+    ('ANO', 'ANO'),
+    ('SEXO', 'SEXO'),
+    ('IDADE SENASP', 'FAIXA_IDADE'),
+    ('TOTAL DE VÍTIMAS', 'TOTAL')
+)
 
 
-@st.cache_data
 def carregar_dados_vd(arquivo, sheet):
-    df = pd.read_excel(arquivo, sheet_name=sheet)
-    df = df.rename(columns={
-        'MUNICÍPIO DO FATO': 'MUNICIPIO',
-        'REGIAO GEOGRÁFICA': 'REGIAO_GEOGRAFICA',
-        'DATA DO FATO': 'DATA',
-        'IDADE SENASP': 'FAIXA_IDADE',
-        'TOTAL DE VÍTIMAS': 'TOTAL'
-    })
-    df['DATA'] = pd.to_datetime(df['DATA'])
-    df['MES'] = df['DATA'].dt.month
-    return df
+    """Carrega e prepara os dados de Violência Doméstica, renomeando as colunas da planilha"""
+    return carregar_dados(arquivo, sheet, COLUNAS_PLANILHA)
+
+
+@st.cache_data(show_spinner=False)
+def obter_opcoes_vd(arquivo, sheet):
+    """Valores disponíveis nos filtros, calculados uma única vez por base"""
+    df = carregar_dados_vd(arquivo, sheet)
+    return listar_opcoes(df, ['ANO', 'NATUREZA', 'SEXO'])
+
+
+def _filtrar_vd(df, ano_inicio, ano_fim, naturezas, sexos):
+    anos = df['ANO'].to_numpy()
+    mascara = (anos >= ano_inicio) & (anos <= ano_fim)
+    if 'Todas' not in naturezas:
+        mascara &= mascara_valores(df['NATUREZA'], naturezas)
+    if 'Todos' not in sexos:
+        mascara &= mascara_valores(df['SEXO'], sexos)
+    return df[mascara]
+
+
+@st.cache_data(show_spinner=False)
+def gerar_csv_vd(arquivo, sheet, ano_inicio, ano_fim, naturezas, sexos):
+    """Serializa os dados filtrados em CSV uma única vez por combinação de filtros"""
+    df = carregar_dados_vd(arquivo, sheet)
+    df_filt = _filtrar_vd(df, ano_inicio, ano_fim, naturezas, sexos).drop(columns=COLUNAS_INTERNAS)
+    return exportar_csv(df_filt)
+
+
+@st.cache_data(show_spinner=False)
+def gerar_parquet_vd(arquivo, sheet, ano_inicio, ano_fim, naturezas, sexos):
+    """Serializa os dados filtrados em Parquet uma única vez por combinação de filtros"""
+    df = carregar_dados_vd(arquivo, sheet)
+    df_filt = _filtrar_vd(df, ano_inicio, ano_fim, naturezas, sexos).drop(columns=COLUNAS_INTERNAS)
+    return exportar_parquet(df_filt)
 
 
 def render(base_info):
@@ -32,24 +71,38 @@ def render(base_info):
     st.markdown(f"**Período:** {base_info['periodo']} | **Total de registros:** {len(df):,}")
     
     # Filtros
+    opcoes = obter_opcoes_vd(base_info['arquivo'], base_info['sheet'])
     st.sidebar.header("🔍 Filtros")
-    anos = sorted(df['ANO'].unique())
+    anos = opcoes['ANO']
     col1, col2 = st.sidebar.columns(2)
     ano_inicio = col1.selectbox("Ano inicial", anos, index=0)
     ano_fim = col2.selectbox("Ano final", anos, index=len(anos)-1)
     
-    naturezas = ['Todas'] + sorted(df['NATUREZA'].unique().tolist())
+    naturezas = ['Todas'] + opcoes['NATUREZA']
     natureza = st.sidebar.multiselect("Natureza", naturezas, default=['Todas'])
     
-    sexos = ['Todos'] + sorted(df['SEXO'].unique().tolist())
+    sexos = ['Todos'] + opcoes['SEXO']
     sexo = st.sidebar.multiselect("Sexo", sexos, default=['Todos'])
     
+    st.sidebar.markdown("---")
+    render_mode = escolher_modo_renderizacao()
+    
     # Aplicar filtros
-    df_filt = df[(df['ANO'] >= ano_inicio) & (df['ANO'] <= ano_fim)]
-    if 'Todas' not in natureza:
-        df_filt = df_filt[df_filt['NATUREZA'].isin(natureza)]
-    if 'Todos' not in sexo:
-        df_filt = df_filt[df_filt['SEXO'].isin(sexo)]
+    filtros = (ano_inicio, ano_fim, tuple(natureza), tuple(sexo))
+    df_filt = _filtrar_vd(df, *filtros)
+    
+    agregados = somar_por_grupos(df_filt, 'TOTAL', {
+        'por_ano': ('ANO', False),
+        'por_mes': ('MES', False),
+        'por_natureza': ('NATUREZA', True),
+        'por_ano_natureza': (['ANO', 'NATUREZA'], False),
+        'por_natureza_sexo': (['NATUREZA', 'SEXO'], False),
+        'por_municipio': ('MUNICIPIO', True),
+        'por_regiao': ('REGIAO_GEOGRAFICA', False),
+        'por_sexo': ('SEXO', False),
+        'por_faixa_idade': ('FAIXA_IDADE', True)
+    })
+    top_nat = agregados['por_natureza']['NATUREZA'].head(10)
     
     # Métricas
     st.header("📊 Indicadores")
@@ -57,15 +110,16 @@ def render(base_info):
     with col1:
         st.metric("Total de Casos", f"{df_filt['TOTAL'].sum():,}")
     with col2:
-        st.metric("Média Anual", f"{df_filt.groupby('ANO')['TOTAL'].sum().mean():.0f}")
+        st.metric("Média Anual", f"{agregados['por_ano']['TOTAL'].mean():.0f}")
     with col3:
-        st.metric("Municípios", f"{df_filt['MUNICIPIO'].nunique()}")
+        st.metric("Municípios", f"{contar_distintos(df_filt['MUNICIPIO'])}")
     with col4:
-        fem = df_filt[df_filt['SEXO'].str.contains('FEM', case=False, na=False)]
-        perc = (fem['TOTAL'].sum() / df_filt['TOTAL'].sum() * 100) if df_filt['TOTAL'].sum() > 0 else 0
+        totais = df_filt['TOTAL'].to_numpy()
+        total = totais.sum()
+        perc = ((totais * df_filt['_IS_FEM'].to_numpy()).sum() / total * 100) if total > 0 else 0
         st.metric("% Feminino", f"{perc:.1f}%")
     with col5:
-        tipos = df_filt['NATUREZA'].nunique()
+        tipos = contar_distintos(df_filt['NATUREZA'])
         st.metric("Tipos de Crime", f"{tipos}")
     
     st.markdown("---")
@@ -76,23 +130,23 @@ def render(base_info):
     with tab1:
         col1, col2 = st.columns(2)
         with col1:
-            df_ano = df_filt.groupby('ANO')['TOTAL'].sum().reset_index()
-            fig = px.line(df_ano, x='ANO', y='TOTAL', markers=True, title='Evolução Anual')
+            fig = px.line(agregados['por_ano'], x='ANO', y='TOTAL', markers=True, title='Evolução Anual',
+                          render_mode=render_mode)
             fig.update_traces(line_color='#9467bd', line_width=3)
-            st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(reamostrar_figura(fig), use_container_width=True)
         
         with col2:
-            df_mes = df_filt.groupby('MES')['TOTAL'].sum().reset_index()
-            df_mes['MES_NOME'] = df_mes['MES'].apply(lambda x: calendar.month_abbr[x])
+            df_mes = agregados['por_mes']
+            df_mes['MES_NOME'] = nomear_meses(df_mes['MES'])
             fig = px.bar(df_mes, x='MES_NOME', y='TOTAL', title='Distribuição Mensal')
             st.plotly_chart(fig, use_container_width=True)
         
         st.subheader("Evolução por Natureza (Top 10)")
-        top_nat = df_filt.groupby('NATUREZA')['TOTAL'].sum().sort_values(ascending=False).head(10).index
-        df_nat_ano = df_filt[df_filt['NATUREZA'].isin(top_nat)].groupby(['ANO', 'NATUREZA'])['TOTAL'].sum().reset_index()
-        fig = px.line(df_nat_ano, x='ANO', y='TOTAL', color='NATUREZA', markers=True)
+        df_nat_ano = agregados['por_ano_natureza']
+        df_nat_ano = df_nat_ano[df_nat_ano['NATUREZA'].isin(top_nat)]
+        fig = px.line(df_nat_ano, x='ANO', y='TOTAL', color='NATUREZA', markers=True, render_mode=render_mode)
         fig.update_layout(height=500)
-        st.plotly_chart(fig, use_container_width=True)
+        st.plotly_chart(reamostrar_figura(fig), use_container_width=True)
     
     with tab2:
         st.subheader("🗺️ Mapa")
@@ -102,20 +156,22 @@ def render(base_info):
             top_n = st.slider("Top N", 5, 30, 20)
         with col1:
             ano_f = None if ano_map == 'Todos' else ano_map
-            mapa = criar_mapa_calor(df_filt, 'MUNICIPIO', 'TOTAL', ano_f, None, top_n)
-            from streamlit_folium import st_folium
-            st_folium(mapa, width=700, height=500)
+            if ano_f is None:
+                # Sem recorte de ano o top N é o mesmo ranking já agregado
+                df_top = agregados['por_municipio'].head(top_n)
+            else:
+                df_top = agregar_mapa_calor(df_filt, 'MUNICIPIO', 'TOTAL', ano_f, None, top_n)
+            components.html(html_mapa_calor(df_top, 'MUNICIPIO', 'TOTAL'), width=700, height=500)
         
         col1, col2 = st.columns(2)
         with col1:
-            df_mun = df_filt.groupby('MUNICIPIO')['TOTAL'].sum().sort_values(ascending=False).head(15).reset_index()
+            df_mun = agregados['por_municipio'].head(15)
             fig = px.bar(df_mun, x='TOTAL', y='MUNICIPIO', orientation='h', title='Top 15 MunicÃ­pios')
             fig.update_layout(yaxis={'categoryorder':'total ascending'})
             st.plotly_chart(fig, use_container_width=True)
         
         with col2:
-            df_reg = df_filt.groupby('REGIAO_GEOGRAFICA')['TOTAL'].sum().reset_index()
-            fig = px.pie(df_reg, values='TOTAL', names='REGIAO_GEOGRAFICA', hole=0.4, title='Por RegiÃ£o')
+            fig = px.pie(agregados['por_regiao'], values='TOTAL', names='REGIAO_GEOGRAFICA', hole=0.4, title='Por RegiÃ£o')
             st.plotly_chart(fig, use_container_width=True)
     
     with tab3:
@@ -123,20 +179,18 @@ def render(base_info):
         col1, col2 = st.columns(2)
         with col1:
             st.subheader("Por Sexo")
-            df_sexo = df_filt.groupby('SEXO')['TOTAL'].sum().reset_index()
-            fig = px.pie(df_sexo, values='TOTAL', names='SEXO')
+            fig = px.pie(agregados['por_sexo'], values='TOTAL', names='SEXO')
             st.plotly_chart(fig, use_container_width=True)
         
         with col2:
             st.subheader("Por Faixa Etária")
-            df_idade = df_filt.groupby('FAIXA_IDADE')['TOTAL'].sum().sort_values(ascending=False).reset_index()
-            fig = px.bar(df_idade, x='TOTAL', y='FAIXA_IDADE', orientation='h')
+            fig = px.bar(agregados['por_faixa_idade'], x='TOTAL', y='FAIXA_IDADE', orientation='h')
             fig.update_layout(yaxis={'categoryorder':'total ascending'})
             st.plotly_chart(fig, use_container_width=True)
         
         st.subheader("Natureza por Sexo (Top 10)")
-        top_nat = df_filt.groupby('NATUREZA')['TOTAL'].sum().sort_values(ascending=False).head(10).index
-        df_nat_sex = df_filt[df_filt['NATUREZA'].isin(top_nat)].groupby(['NATUREZA', 'SEXO'])['TOTAL'].sum().reset_index()
+        df_nat_sex = agregados['por_natureza_sexo']
+        df_nat_sex = df_nat_sex[df_nat_sex['NATUREZA'].isin(top_nat)]
         fig = px.bar(df_nat_sex, x='NATUREZA', y='TOTAL', color='SEXO', barmode='group')
         fig.update_layout(height=400, xaxis={'tickangle': -45})
         st.plotly_chart(fig, use_container_width=True)
@@ -145,18 +199,25 @@ def render(base_info):
         col1, col2 = st.columns(2)
         with col1:
             st.subheader("Ranking Municípios")
-            df_rank = df_filt.groupby('MUNICIPIO')['TOTAL'].sum().sort_values(ascending=False).head(20).reset_index()
+            df_rank = agregados['por_municipio'].head(20)
             st.dataframe(df_rank, use_container_width=True)
         
         with col2:
             st.subheader("Por Natureza do Crime")
-            df_nat = df_filt.groupby('NATUREZA')['TOTAL'].sum().sort_values(ascending=False).head(15).reset_index()
+            df_nat = agregados['por_natureza'].head(15)
             st.dataframe(df_nat, use_container_width=True)
         
-        csv = df_filt.to_csv(index=False).encode('utf-8')
-        st.download_button("📥 Download CSV", data=csv,
-                          file_name=f'violencia_domestica_pe_{datetime.now().strftime("%Y%m%d")}.csv',
-                          mime='text/csv')
+        parquet = gerar_parquet_vd(base_info['arquivo'], base_info['sheet'], *filtros)
+        st.download_button("📥 Download Parquet", data=parquet,
+                          file_name=f'violencia_domestica_pe_{datetime.now().strftime("%Y%m%d")}.parquet',
+                          mime='application/octet-stream')
+        
+        # CSV só é gerado quando pedido
+        if st.checkbox("Exportar também em CSV"):
+            csv = gerar_csv_vd(base_info['arquivo'], base_info['sheet'], *filtros)
+            st.download_button("📥 Download CSV", data=csv,
+                              file_name=f'violencia_domestica_pe_{datetime.now().strftime("%Y%m%d")}.csv',
+                              mime='text/csv')
 
 
 
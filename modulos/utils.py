@@ -3,18 +3,249 @@ Funções auxiliares comuns para todos os módulos de análise
 """
 import streamlit as st
 import pandas as pd
+import numpy as np
+import polars as pl
 import plotly.express as px
 import plotly.graph_objects as go
 import calendar
+import glob
+import io
+import os
+import re
 import folium
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from pathlib import Path
 from streamlit_folium import st_folium
 from coordenadas import COORDENADAS_MUNICIPIOS
 
 
-def criar_mapa_calor(df, col_municipio, col_vitimas, ano=None, mes=None, top_n=20):
+# Incrementar sempre que o formato do DataFrame salvo em Parquet mudar
+VERSAO_CACHE = 12
+
+# Abreviações dos meses indexadas pelo número do mês (posição 0 vazia)
+MES_ABBR = np.array(list(calendar.month_abbr))
+
+# Acima deste número de pontos por série o gráfico é reamostrado no servidor
+LIMITE_PONTOS_GRAFICO = 1000
+
+# Colunas de texto com poucos valores distintos, guardadas como category
+COLUNAS_CATEGORICAS = ['MUNICIPIO', 'REGIAO_GEOGRAFICA', 'SEXO', 'NATUREZA', 'FAIXA_IDADE']
+
+# Colunas de contagem de casos/vítimas, guardadas como inteiros sem sinal
+COLUNAS_TOTAIS = ['TOTAL', 'TOTAL DE VITIMAS']
+
+# Limites e rótulos das faixas etárias derivadas de IDADE
+LIMITES_FAIXA_ETARIA = [0, 12, 17, 24, 29, 39, 49, 59, 100]
+ROTULOS_FAIXA_ETARIA = ['0-12', '13-17', '18-24', '25-29', '30-39', '40-49', '50-59', '60+']
+
+# Indicadores auxiliares criados por carregar_dados, fora da exportação
+COLUNAS_INTERNAS = ['_IS_FEM', '_IS_MASC']
+
+# Coordenadas em formato tabular, para cruzar com os totais por município
+_COORDENADAS_DF = pd.DataFrame(
+    [(mun, c['lat'], c['lon']) for mun, c in COORDENADAS_MUNICIPIOS.items()],
+    columns=['_MUNICIPIO_NORM', 'lat', 'lon']
+)
+
+# Faixas de intensidade do mapa (fração do maior total) e suas cores
+_LIMITES_INTENSIDADE = [-np.inf, 0.2, 0.4, 0.7, np.inf]
+_CORES_INTENSIDADE = ['#FFA07A', '#FF6347', '#DC143C', '#8B0000']
+
+
+def otimizar_tipos(df, colunas_categoricas=COLUNAS_CATEGORICAS):
     """
-    Cria um mapa de calor interativo com os municípios
-    
+    Converte colunas de texto repetitivas em category, reduz os inteiros
+    ao menor tipo que comporta os valores e guarda as datas em segundos
+
+    Args:
+        df: DataFrame já com as colunas padronizadas
+        colunas_categoricas: Colunas a converter em category (as ausentes são ignoradas)
+
+    Returns:
+        DataFrame com os tipos otimizados
+    """
+    for col in colunas_categoricas:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+
+    if 'DATA' in df.columns:
+        # Precisão de nanossegundos não é usada; datas em segundos bastam
+        df['DATA'] = df['DATA'].astype('datetime64[s]')
+    if 'ANO' in df.columns:
+        df['ANO'] = df['ANO'].astype('int16')
+    if 'MES' in df.columns:
+        df['MES'] = df['MES'].astype('int8')
+    if 'DIA' in df.columns:
+        df['DIA'] = df['DIA'].astype('int8')
+    if 'IDADE' in df.columns:
+        # Idade tem vazios, então fica em ponto flutuante
+        df['IDADE'] = df['IDADE'].astype('float32')
+
+    for col in COLUNAS_TOTAIS:
+        if col in df.columns:
+            # Vazios contam como zero, como já faria o sum() do pandas
+            df[col] = pd.to_numeric(df[col].fillna(0), downcast='unsigned')
+
+    return df
+
+
+def ler_excel_com_cache(arquivo, sheet, preparar=None, colunas=None):
+    """
+    Lê a planilha com o engine calamine e guarda o resultado em Parquet
+    ao lado do arquivo original, reaproveitado nas próximas inicializações
+
+    Args:
+        arquivo: Caminho do arquivo Excel
+        sheet: Nome da aba da planilha
+        preparar: Função aplicada ao DataFrame lido antes de salvar o cache
+        colunas: Colunas da planilha a ler (None = todas)
+
+    Returns:
+        DataFrame preparado
+    """
+    caminho_excel = Path(arquivo)
+    # Uma aba por arquivo de cache, para que bases da mesma planilha não se misturem
+    nome_aba = re.sub(r'[^\w-]+', '_', str(sheet))
+    prefixo_cache = f'{caminho_excel.stem}.{nome_aba}.v'
+    caminho_cache = caminho_excel.with_name(f'{prefixo_cache}{VERSAO_CACHE}.parquet')
+
+    # O cache só vale se for mais novo que a planilha
+    if caminho_cache.exists() and caminho_cache.stat().st_mtime >= caminho_excel.stat().st_mtime:
+        try:
+            return pd.read_parquet(caminho_cache)
+        except (OSError, ValueError):
+            # Cache corrompido ou ilegível: relê a planilha e o recria
+            pass
+
+    df = pd.read_excel(caminho_excel, sheet_name=sheet, engine='calamine', usecols=colunas)
+    if preparar is not None:
+        df = preparar(df)
+
+    # Grava num arquivo temporário e só então substitui o cache, para que uma
+    # interrupção no meio da escrita não deixe um Parquet truncado no lugar
+    caminho_temp = caminho_cache.with_name(f'.{caminho_cache.name}')
+    try:
+        df.to_parquet(caminho_temp, compression='zstd')
+        os.replace(caminho_temp, caminho_cache)
+    except OSError:
+        # Diretório somente leitura: segue sem o cache em disco
+        caminho_temp.unlink(missing_ok=True)
+    else:
+        # Remove os caches desta aba gravados por versões anteriores
+        for antigo in caminho_cache.parent.glob(f'{glob.escape(prefixo_cache)}*.parquet'):
+            if antigo != caminho_cache and re.fullmatch(r'\d+', antigo.name[len(prefixo_cache):-len('.parquet')]):
+                try:
+                    antigo.unlink(missing_ok=True)
+                except OSError:
+                    # Sem permissão para apagar: o arquivo antigo só ocupa espaço
+                    pass
+
+    return df
+
+
+@st.cache_resource(show_spinner=False)
+def carregar_dados(arquivo, sheet, colunas, regiao_zero_nao_informada=False):
+    """
+    Carregador único das bases de microdados: padroniza os nomes das colunas
+    e deriva as colunas de data, faixa etária e sexo. O DataFrame é
+    compartilhado entre as sessões sem cópia, então deve ser tratado como
+    somente leitura.
+
+    Args:
+        arquivo: Caminho do arquivo Excel
+        sheet: Nome da aba da planilha
+        colunas: Tupla de pares (nome na planilha, nome padronizado); só
+                 essas colunas são lidas
+        regiao_zero_nao_informada: Trocar a região 0 por 'NÃO INFORMADO'
+
+    Returns:
+        DataFrame preparado
+    """
+    def preparar(df):
+        df = df.rename(columns=dict(colunas))
+
+        df['DATA'] = pd.to_datetime(df['DATA'])
+        df['MES'] = df['DATA'].dt.month
+        df['DIA'] = df['DATA'].dt.day
+
+        if 'IDADE' in df.columns:
+            df['FAIXA_ETARIA'] = pd.cut(df['IDADE'], bins=LIMITES_FAIXA_ETARIA, labels=ROTULOS_FAIXA_ETARIA,
+                                        include_lowest=True)
+
+        if regiao_zero_nao_informada:
+            # Região não informada vem como 0 na planilha
+            df['REGIAO_GEOGRAFICA'] = df['REGIAO_GEOGRAFICA'].replace(0, 'NÃO INFORMADO')
+
+        if 'SEXO' in df.columns:
+            # Indicadores 0/1 para as métricas de %, sem busca de texto a cada rerun
+            sexo = df['SEXO'].astype(str).str.upper()
+            df['_IS_FEM'] = sexo.str.contains('FEM').astype('uint8')
+            df['_IS_MASC'] = sexo.str.contains('MASC').astype('uint8')
+
+        return otimizar_tipos(df, COLUNAS_CATEGORICAS + ['NATUREZA JURIDICA'])
+
+    return ler_excel_com_cache(arquivo, sheet, preparar, [original for original, _ in colunas])
+
+
+def exportar_csv(df):
+    """
+    Serializa o DataFrame em CSV com o escritor nativo do PyArrow,
+    bem mais rápido que o to_csv do pandas em bases grandes
+
+    Args:
+        df: DataFrame a exportar
+
+    Returns:
+        Bytes do CSV (UTF-8, com cabeçalho e sem índice)
+    """
+    tabela = pa.Table.from_pandas(df, preserve_index=False)
+    # O escritor de CSV não aceita colunas dictionary (category)
+    for i, campo in enumerate(tabela.schema):
+        if pa.types.is_dictionary(campo.type):
+            tabela = tabela.set_column(i, campo.name, tabela.column(i).cast(campo.type.value_type))
+
+    buffer = io.BytesIO()
+    pacsv.write_csv(tabela, buffer)
+    return buffer.getvalue()
+
+
+def exportar_parquet(df):
+    """
+    Serializa o DataFrame em Parquet comprimido com zstd
+
+    Args:
+        df: DataFrame a exportar
+
+    Returns:
+        Bytes do arquivo Parquet
+    """
+    buffer = io.BytesIO()
+    df.to_parquet(buffer, compression='zstd', index=False)
+    return buffer.getvalue()
+
+
+@st.cache_data(show_spinner=False)
+def html_mapa_calor(df_mapa_agg, col_municipio, col_vitimas):
+    """
+    Gera o HTML do mapa de calor a partir do top N já agregado. Como recebe
+    só algumas dezenas de linhas, o hash da chave do cache é imediato.
+
+    Args:
+        df_mapa_agg: Resultado de agregar_mapa_calor
+        col_municipio: Nome da coluna com os municípios
+        col_vitimas: Nome da coluna com número de vítimas/casos
+
+    Returns:
+        HTML completo do mapa
+    """
+    return desenhar_mapa_calor(df_mapa_agg, col_municipio, col_vitimas).get_root().render()
+
+
+def agregar_mapa_calor(df, col_municipio, col_vitimas, ano=None, mes=None, top_n=20):
+    """
+    Soma os casos por município e mantém os top N que vão para o mapa
+
     Args:
         df: DataFrame com os dados
         col_municipio: Nome da coluna com os municípios
@@ -22,64 +253,66 @@ def criar_mapa_calor(df, col_municipio, col_vitimas, ano=None, mes=None, top_n=2
         ano: Ano específico para filtrar (None = todos)
         mes: Mês específico para filtrar (None = todos)
         top_n: Número de municípios a exibir
-    
+
     Returns:
-        Mapa folium
+        DataFrame com as colunas de município e total, em ordem decrescente
     """
-    df_mapa = df.copy()
+    # Aplicar filtros (a seleção por máscara já gera um novo DataFrame, sem cópia prévia)
+    mascara = np.ones(len(df), dtype=bool)
+    if ano is not None and 'ANO' in df.columns:
+        mascara &= df['ANO'].to_numpy() == ano
     
-    # Aplicar filtros
-    if ano is not None and 'ANO' in df_mapa.columns:
-        df_mapa = df_mapa[df_mapa['ANO'] == ano]
+    if mes is not None and 'MES' in df.columns:
+        mascara &= df['MES'].to_numpy() == mes
     
-    if mes is not None and 'MES' in df_mapa.columns:
-        df_mapa = df_mapa[df_mapa['MES'] == mes]
+    df_mapa = df[[col_municipio, col_vitimas]][mascara]
     
     # Agrupar por município
-    df_mapa_agg = df_mapa.groupby(col_municipio)[col_vitimas].sum().sort_values(ascending=False).head(top_n).reset_index()
-    
+    return df_mapa.groupby(col_municipio, observed=True, sort=False)[col_vitimas].sum().nlargest(top_n).reset_index()
+
+
+def desenhar_mapa_calor(df_mapa_agg, col_municipio, col_vitimas):
+    """
+    Desenha o mapa folium com um círculo por município
+
+    Args:
+        df_mapa_agg: Resultado de agregar_mapa_calor
+        col_municipio: Nome da coluna com os municípios
+        col_vitimas: Nome da coluna com número de vítimas/casos
+
+    Returns:
+        Mapa folium
+    """
     # Criar mapa centrado em Pernambuco
     m = folium.Map(location=[-8.0476, -35.8770], zoom_start=7, tiles='OpenStreetMap')
     
     if len(df_mapa_agg) == 0:
         return m
     
-    max_vitimas = df_mapa_agg[col_vitimas].max()
-    
-    for _, row in df_mapa_agg.iterrows():
-        municipio = row[col_municipio]
-        vitimas = row[col_vitimas]
-        
-        # Normalizar nome do município para buscar coordenadas
-        municipio_upper = municipio.upper().strip()
-        
-        if municipio_upper in COORDENADAS_MUNICIPIOS:
-            coords = COORDENADAS_MUNICIPIOS[municipio_upper]
-            
-            # Calcular tamanho proporcional
-            radius = (vitimas / max_vitimas) * 30000 + 5000
-            
-            # Definir cor baseada na intensidade
-            if vitimas > max_vitimas * 0.7:
-                color = '#8B0000'
-            elif vitimas > max_vitimas * 0.4:
-                color = '#DC143C'
-            elif vitimas > max_vitimas * 0.2:
-                color = '#FF6347'
-            else:
-                color = '#FFA07A'
-            
-            folium.Circle(
-                location=[coords['lat'], coords['lon']],
-                radius=radius,
-                popup=f"<b>{municipio}</b><br>Total: {vitimas:,}",
-                tooltip=f"{municipio}: {vitimas:,}",
-                color=color,
-                fill=True,
-                fillColor=color,
-                fillOpacity=0.6,
-                weight=2
-            ).add_to(m)
+    # Normalizar nome do município e buscar as coordenadas de todos de uma vez
+    nomes = df_mapa_agg[col_municipio].astype(str)
+    df_pontos = df_mapa_agg.assign(_MUNICIPIO_NORM=nomes.str.upper().str.strip().to_numpy())
+    df_pontos = df_pontos.merge(_COORDENADAS_DF, on='_MUNICIPIO_NORM', how='inner')
+    
+    # Tamanho proporcional e cor pela intensidade, calculados na coluna inteira
+    intensidade = df_pontos[col_vitimas] / max(df_mapa_agg[col_vitimas].max(), 1)
+    raios = (intensidade * 30000 + 5000).to_numpy()
+    cores = pd.cut(intensidade, _LIMITES_INTENSIDADE, labels=_CORES_INTENSIDADE).astype(str).to_numpy()
+    
+    for municipio, vitimas, lat, lon, radius, color in zip(
+        df_pontos[col_municipio], df_pontos[col_vitimas], df_pontos['lat'], df_pontos['lon'], raios, cores
+    ):
+        folium.Circle(
+            location=[lat, lon],
+            radius=radius,
+            popup=f"<b>{municipio}</b><br>Total: {vitimas:,}",
+            tooltip=f"{municipio}: {vitimas:,}",
+            color=color,
+            fill=True,
+            fillColor=color,
+            fillOpacity=0.6,
+            weight=2
+        ).add_to(m)
     
     # Adicionar legenda
     legend_html = '''
@@ -99,132 +332,263 @@ def criar_mapa_calor(df, col_municipio, col_vitimas, ano=None, mes=None, top_n=2
     return m
 
 
-def criar_filtros_padrao(df, prefixo_colunas=None):
+def nomear_meses(meses):
     """
-    Cria filtros padrão na sidebar
+    Converte números de mês (1-12) em abreviações, como categoria ordenada
+    de Jan a Dec para manter a ordem do eixo nos gráficos
+    
+    Args:
+        meses: Series ou array com os números dos meses
+    
+    Returns:
+        pd.Categorical com as abreviações
+    """
+    return pd.Categorical(MES_ABBR[np.asarray(meses)], categories=MES_ABBR[1:].tolist(), ordered=True)
+
+
+def reamostrar_figura(fig, n_pontos=LIMITE_PONTOS_GRAFICO):
+    """
+    Reamostra as séries da figura com LTTB quando alguma passa de n_pontos,
+    reduzindo o JSON enviado ao navegador
+    
+    Args:
+        fig: Figura plotly
+        n_pontos: Número máximo de pontos exibidos por série
+    
+    Returns:
+        A própria figura, ou um FigureResampler quando há reamostragem
+    """
+    maior_serie = max((len(trace.x) for trace in fig.data if trace.x is not None), default=0)
+    if maior_serie <= n_pontos:
+        return fig
+    
+    from plotly_resampler import FigureResampler
+    from plotly_resampler.aggregation import LTTB
+    return FigureResampler(fig, default_n_shown_samples=n_pontos, default_downsampler=LTTB())
+
+
+def escolher_modo_renderizacao():
+    """
+    Cria na sidebar a opção de desenhar os gráficos de linha com WebGL
+    
+    Returns:
+        'webgl' (padrão) ou 'svg', para o parâmetro render_mode do plotly express
+    """
+    usar_webgl = st.sidebar.checkbox(
+        "Gráficos com WebGL",
+        value=True,
+        help="Desmarque se os gráficos não aparecerem (navegador sem suporte a WebGL)"
+    )
+    return 'webgl' if usar_webgl else 'svg'
+
+
+def valores_distintos(serie):
+    """
+    Lista ordenada dos valores distintos de uma coluna. Em colunas category
+    usa as categorias já ordenadas, sem percorrer as linhas.
+    """
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        return serie.cat.categories.tolist()
+    return sorted(serie.dropna().unique().tolist())
+
+
+def listar_opcoes(df, colunas):
+    """
+    Monta as opções dos filtros da sidebar
     
     Args:
         df: DataFrame com os dados
-        prefixo_colunas: Dict com mapeamento de nomes de colunas {padrão: real}
-                        Ex: {'municipio': 'MUNICIPIO DO FATO', 'regiao': 'REGIAO GEOGRAFICA'}
+        colunas: Colunas para as quais listar os valores (as ausentes são ignoradas)
+    
+    Returns:
+        Dict {coluna: lista ordenada de valores}
+    """
+    return {col: valores_distintos(df[col]) for col in colunas if col in df.columns}
+
+
+def criar_filtros_padrao(df, opcoes=None):
+    """
+    Cria filtros padrão na sidebar
+    
+    Args:
+        df: DataFrame com os dados, com as colunas já padronizadas pelo carregador
+        opcoes: Dict {coluna: valores} já calculado (ver listar_opcoes); as colunas
+                ausentes são lidas do DataFrame
     
     Returns:
         Dict com os filtros aplicados
     """
-    if prefixo_colunas is None:
-        prefixo_colunas = {}
+    if opcoes is None:
+        opcoes = {}
     
-    filtros = {}
+    def obter_opcoes(col):
+        return opcoes[col] if col in opcoes else valores_distintos(df[col])
     
-    # Mapeamento de colunas
-    col_ano = prefixo_colunas.get('ano', 'ANO')
-    col_mes = prefixo_colunas.get('mes', 'MES')
-    col_regiao = prefixo_colunas.get('regiao', 'REGIAO_GEOGRAFICA')
-    col_municipio = prefixo_colunas.get('municipio', 'MUNICIPIO')
-    col_sexo = prefixo_colunas.get('sexo', 'SEXO')
-    col_idade = prefixo_colunas.get('idade', 'IDADE')
+    filtros = {}
     
     st.sidebar.header("🔍 Filtros")
     
     # Filtro de ano
-    if col_ano in df.columns:
-        anos_disponiveis = sorted(df[col_ano].unique())
+    if 'ANO' in df.columns:
+        anos_disponiveis = obter_opcoes('ANO')
         col_ano1, col_ano2 = st.sidebar.columns(2)
         filtros['ano_inicio'] = col_ano1.selectbox("Ano inicial", anos_disponiveis, index=0)
         filtros['ano_fim'] = col_ano2.selectbox("Ano final", anos_disponiveis, index=len(anos_disponiveis)-1)
     
     # Filtro de mês
-    if col_mes in df.columns or 'DATA' in df.columns:
+    if 'MES' in df.columns or 'DATA' in df.columns:
         meses = ['Todos'] + [calendar.month_name[i] for i in range(1, 13)]
         filtros['meses'] = st.sidebar.multiselect("Mês", options=meses, default=['Todos'])
     
     # Filtro de região
-    if col_regiao in df.columns:
-        regioes = ['Todas'] + sorted(df[col_regiao].unique().tolist())
+    if 'REGIAO_GEOGRAFICA' in df.columns:
+        regioes = ['Todas'] + obter_opcoes('REGIAO_GEOGRAFICA')
         filtros['regioes'] = st.sidebar.multiselect("Região Geográfica", options=regioes, default=['Todas'])
     
     # Filtro de município
-    if col_municipio in df.columns:
-        municipios = ['Todos'] + sorted(df[col_municipio].unique().tolist())
+    if 'MUNICIPIO' in df.columns:
+        municipios = ['Todos'] + obter_opcoes('MUNICIPIO')
         filtros['municipios'] = st.sidebar.multiselect("Município", options=municipios, default=['Todos'])
     
     # Filtro de sexo
-    if col_sexo in df.columns:
-        sexos = ['Todos'] + sorted(df[col_sexo].unique().tolist())
+    if 'SEXO' in df.columns:
+        sexos = ['Todos'] + obter_opcoes('SEXO')
         filtros['sexos'] = st.sidebar.multiselect("Sexo", options=sexos, default=['Todos'])
     
     # Filtro de idade
-    if col_idade in df.columns:
-        idade_valida = df[col_idade].dropna()
-        if len(idade_valida) > 0:
+    if 'IDADE' in df.columns:
+        idades = obter_opcoes('IDADE')
+        if len(idades) > 0:
+            idade_min, idade_max = int(idades[0]), int(idades[-1])
             filtros['idade_min'], filtros['idade_max'] = st.sidebar.slider(
                 "Faixa Etária",
-                min_value=int(idade_valida.min()),
-                max_value=int(idade_valida.max()),
-                value=(int(idade_valida.min()), int(idade_valida.max()))
+                min_value=idade_min,
+                max_value=idade_max,
+                value=(idade_min, idade_max)
             )
     
     return filtros
 
 
-def aplicar_filtros(df, filtros, prefixo_colunas=None):
+def somar_por_grupos(df, col_valor, grupos):
     """
-    Aplica os filtros ao DataFrame
+    Soma uma coluna em vários agrupamentos de uma vez com o Polars, que
+    executa as consultas em paralelo
     
     Args:
-        df: DataFrame original
-        filtros: Dict com os filtros (retorno de criar_filtros_padrao)
-        prefixo_colunas: Dict com mapeamento de nomes de colunas
+        df: DataFrame pandas com os dados
+        col_valor: Coluna a ser somada
+        grupos: Dict {nome: (chaves, ordenar_por_total)}; com ordenar_por_total
+                os empates no total saem pelas chaves, sem ele o resultado sai
+                ordenado pelas chaves
     
     Returns:
-        DataFrame filtrado
+        Dict {nome: DataFrame pandas com as chaves e a soma}
+    """
+    colunas = {col_valor}
+    for chaves, _ in grupos.values():
+        colunas.update([chaves] if isinstance(chaves, str) else chaves)
+    lf = pl.from_pandas(df[[c for c in df.columns if c in colunas]]).lazy()
+    
+    consultas = []
+    for chaves, ordenar_por_total in grupos.values():
+        # Como no pandas, linhas com chave vazia ficam fora do agrupamento
+        consulta = lf.drop_nulls(chaves).group_by(chaves).agg(pl.col(col_valor).sum())
+        if ordenar_por_total:
+            # Empates no total saem pela ordem das chaves, de forma determinística
+            lista_chaves = [chaves] if isinstance(chaves, str) else list(chaves)
+            consulta = consulta.sort([col_valor] + lista_chaves,
+                                     descending=[True] + [False] * len(lista_chaves))
+        else:
+            consulta = consulta.sort(chaves)
+        consultas.append(consulta)
+    
+    resultados = pl.collect_all(consultas)
+    return {nome: res.to_pandas() for nome, res in zip(grupos, resultados)}
+
+
+def contar_distintos(serie):
     """
-    if prefixo_colunas is None:
-        prefixo_colunas = {}
+    Número de valores distintos (sem vazios). Em colunas category conta os
+    códigos presentes com bincount, sem comparar textos.
     
-    df_filtrado = df.copy()
+    Args:
+        serie: Série pandas
     
-    # Mapeamento de colunas
-    col_ano = prefixo_colunas.get('ano', 'ANO')
-    col_mes = prefixo_colunas.get('mes', 'MES')
-    col_regiao = prefixo_colunas.get('regiao', 'REGIAO_GEOGRAFICA')
-    col_municipio = prefixo_colunas.get('municipio', 'MUNICIPIO')
-    col_sexo = prefixo_colunas.get('sexo', 'SEXO')
-    col_idade = prefixo_colunas.get('idade', 'IDADE')
+    Returns:
+        Quantidade de valores distintos
+    """
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        codigos = serie.cat.codes.to_numpy()
+        presentes = np.bincount(codigos[codigos >= 0], minlength=len(serie.cat.categories))
+        return int(np.count_nonzero(presentes))
+    return serie.nunique()
+
+
+def mascara_valores(serie, valores):
+    """
+    Máscara booleana indicando quais linhas de `serie` estão em `valores`.
+    Em colunas category a comparação é feita sobre os códigos inteiros.
+    
+    Args:
+        serie: Coluna do DataFrame
+        valores: Lista de valores aceitos
+    
+    Returns:
+        Array booleano do NumPy
+    """
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        codigos = serie.cat.categories.get_indexer(list(valores))
+        return np.isin(serie.cat.codes.to_numpy(), codigos[codigos >= 0])
+    return serie.isin(valores).to_numpy()
+
+
+def mascara_filtros(df, filtros):
+    """
+    Monta uma única máscara booleana com todos os filtros padrão
+    
+    Args:
+        df: DataFrame original
+        filtros: Dict com os filtros (retorno de criar_filtros_padrao)
+    
+    Returns:
+        Array booleano do NumPy com uma posição por linha de df
+    """
+    mascara = np.ones(len(df), dtype=bool)
     
     # Filtro de ano
-    if 'ano_inicio' in filtros and 'ano_fim' in filtros and col_ano in df_filtrado.columns:
-        df_filtrado = df_filtrado[(df_filtrado[col_ano] >= filtros['ano_inicio']) & 
-                                   (df_filtrado[col_ano] <= filtros['ano_fim'])]
+    if 'ano_inicio' in filtros and 'ano_fim' in filtros and 'ANO' in df.columns:
+        anos = df['ANO'].to_numpy()
+        mascara &= (anos >= filtros['ano_inicio']) & (anos <= filtros['ano_fim'])
     
     # Filtro de mês
-    if 'meses' in filtros and col_mes in df_filtrado.columns:
+    if 'meses' in filtros and 'MES' in df.columns:
         if 'Todos' not in filtros['meses'] and len(filtros['meses']) > 0:
             meses_nomes = ['Todos'] + [calendar.month_name[i] for i in range(1, 13)]
             meses_numeros = [meses_nomes.index(m) for m in filtros['meses'] if m != 'Todos']
-            df_filtrado = df_filtrado[df_filtrado[col_mes].isin(meses_numeros)]
+            mascara &= mascara_valores(df['MES'], meses_numeros)
     
     # Filtro de região
-    if 'regioes' in filtros and col_regiao in df_filtrado.columns:
+    if 'regioes' in filtros and 'REGIAO_GEOGRAFICA' in df.columns:
         if 'Todas' not in filtros['regioes'] and len(filtros['regioes']) > 0:
-            df_filtrado = df_filtrado[df_filtrado[col_regiao].isin(filtros['regioes'])]
+            mascara &= mascara_valores(df['REGIAO_GEOGRAFICA'], filtros['regioes'])
     
     # Filtro de município
-    if 'municipios' in filtros and col_municipio in df_filtrado.columns:
+    if 'municipios' in filtros and 'MUNICIPIO' in df.columns:
         if 'Todos' not in filtros['municipios'] and len(filtros['municipios']) > 0:
-            df_filtrado = df_filtrado[df_filtrado[col_municipio].isin(filtros['municipios'])]
+            mascara &= mascara_valores(df['MUNICIPIO'], filtros['municipios'])
     
     # Filtro de sexo
-    if 'sexos' in filtros and col_sexo in df_filtrado.columns:
+    if 'sexos' in filtros and 'SEXO' in df.columns:
         if 'Todos' not in filtros['sexos'] and len(filtros['sexos']) > 0:
-            df_filtrado = df_filtrado[df_filtrado[col_sexo].isin(filtros['sexos'])]
+            mascara &= mascara_valores(df['SEXO'], filtros['sexos'])
     
     # Filtro de idade
-    if 'idade_min' in filtros and 'idade_max' in filtros and col_idade in df_filtrado.columns:
-        df_filtrado = df_filtrado[(df_filtrado[col_idade] >= filtros['idade_min']) & 
-                                   (df_filtrado[col_idade] <= filtros['idade_max'])]
+    if 'idade_min' in filtros and 'idade_max' in filtros and 'IDADE' in df.columns:
+        idades = df['IDADE'].to_numpy()
+        mascara &= (idades >= filtros['idade_min']) & (idades <= filtros['idade_max'])
     
-    return df_filtrado
+    return mascara
 
 
 def exibir_metricas_principais(df, col_vitimas='TOTAL DE VITIMAS', col_municipio='MUNICIPIO', 
@@ -240,14 +604,14 @@ def exibir_metricas_principais(df, col_vitimas='TOTAL DE VITIMAS', col_municipio
     
     with col2:
         if col_ano in df.columns:
-            media_anual = df.groupby(col_ano)[col_vitimas if col_vitimas in df.columns else col_ano].sum().mean()
+            media_anual = df.groupby(col_ano, observed=True, sort=False)[col_vitimas if col_vitimas in df.columns else col_ano].sum().mean()
             st.metric("Média Anual", f"{media_anual:.0f}")
         else:
             st.metric("Registros", f"{len(df):,}")
     
     with col3:
         if col_municipio in df.columns:
-            municipios_afetados = df[col_municipio].nunique()
+            municipios_afetados = contar_distintos(df[col_municipio])
             st.metric("Municípios", f"{municipios_afetados}")
         else:
             st.metric("Período", "Múltiplos anos")
@@ -263,7 +627,11 @@ def exibir_metricas_principais(df, col_vitimas='TOTAL DE VITIMAS', col_municipio
             st.metric("Dados", "Disponíveis")
     
     with col5:
-        if col_sexo in df.columns:
+        if '_IS_MASC' in df.columns:
+            # Indicador pré-calculado no carregamento: basta a média da coluna 0/1
+            perc = (df['_IS_MASC'].to_numpy().mean() * 100) if len(df) > 0 else 0
+            st.metric("% Masculino", f"{perc:.1f}%")
+        elif col_sexo in df.columns:
             try:
                 sexo_masc = df[df[col_sexo].str.upper().str.contains('MASC', na=False)]
                 perc = (len(sexo_masc) / len(df) * 100) if len(df) > 0 else 0
@@ -0,0 +1,39 @@
+"""
+Testes da página de Estupro
+"""
+from pathlib import Path
+
+from streamlit.testing.v1 import AppTest
+
+
+RAIZ = Path(__file__).resolve().parent.parent
+
+
+def _pagina_estupro(raiz):
+    import sys
+    sys.path.insert(0, raiz)
+
+    from modulos import analise_estupro
+
+    analise_estupro.render({
+        'nome': 'Estupro',
+        'arquivo': f'{raiz}/dados/MICRODADOS_ESTUPRO_JAN_2015_A_NOV_2025.xlsx',
+        'sheet': 'Plan1',
+        'periodo': 'Janeiro/2015 a Novembro/2025'
+    })
+
+
+def test_render_estupro_com_filtro_sem_resultados():
+    at = AppTest.from_function(_pagina_estupro, args=(str(RAIZ),), default_timeout=600)
+    at.run()
+    assert not at.exception
+
+    # Ano inicial depois do ano final: nenhum registro passa no filtro
+    ano_inicial = next(s for s in at.sidebar.selectbox if s.label == "Ano inicial")
+    ano_final = next(s for s in at.sidebar.selectbox if s.label == "Ano final")
+    ano_inicial.set_value(ano_inicial.options[-1])
+    ano_final.set_value(ano_final.options[0])
+    at.run()
+
+    assert not at.exception
+    assert at.metric[0].value == '0'